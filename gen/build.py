@@ -1,7 +1,20 @@
-from multiprocessing import Pool, cpu_count, Manager
+from multiprocessing import Pool, cpu_count
+from multiprocessing.shared_memory import SharedMemory
+from multiprocessing import resource_tracker
+from contextlib import contextmanager
+from atexit import register
 from functools import partial
+from os import path, makedirs
+from shutil import rmtree
+from hashlib import blake2b
+import json
+from time import time
 import numpy as num
 import trimesh
+from sim.rep import Runs
+from collections import namedtuple as data
+from attrs import define, field
+from typing import *
 
 KINDS = {
     0: "empty",
@@ -12,74 +25,363 @@ KINDS = {
 
 COL = {"shelf": (0.8039, 0.5216, 0.24706), "pile": (0.62745, 0.32157, 0.17647), "wall": (0.6, 0.6, 0.6)}
 
-vertices, faces, normals, colors = [], [], [], []
-def march(stripData, status):
-    ID, (strip, (x0, y0, z0)) = stripData
-    vertices, faces, normals, colors = [], [], [], []
-    faceMap = [
-        ([0, 0, 0], [0, 0, 1], [0, 1, 1], [0, 1, 0], [-1, 0, 0]), # left
-        ([1, 0, 0], [1, 1, 0], [1, 1, 1], [1, 0, 1], [1, 0, 0]),  # right
-        ([0, 0, 0], [1, 0, 0], [1, 0, 1], [0, 0, 1], [0, -1, 0]), # bottom
-        ([0, 1, 0], [0, 1, 1], [1, 1, 1], [1, 1, 0], [0, 1, 0]),  # top
-        ([0, 0, 0], [0, 1, 0], [1, 1, 0], [1, 0, 0], [0, 0, -1]), # back
-        ([0, 0, 1], [1, 0, 1], [1, 1, 1], [0, 1, 1], [0, 0, 1])   # front
-    ]
-
-    for (x, y, z), pos in num.ndenumerate(strip):
-        if pos:
-            for face in faceMap:
-                neighbor = x + face[4][0], y + face[4][1], z + face[4][2]  # face[4]: normal to face
-                if all(0 <= n < dim for n, dim in zip(neighbor, strip.shape)) and strip[neighbor]:
-                    continue  # interior face
-
-                v = len(vertices)
-                vertices.extend([(x + dx + x0, y + dy + y0, z + dz + z0) for (dx, dy, dz) in face[:4]])
-                faces.extend([[v, v + 1, v + 2], [v, v + 2, v + 3]])
-                normals.extend([face[4]]*4)
-                colors.extend([COL.get(KINDS[pos], (0, 0, 0))]*4)
-
-    status[ID] = 1
-    return vertices, faces, normals, colors
-
-def process(cloud, callback):
+def _strip(cloud, i, j):
+    """
+    cloud[i:j] plus one halo row on each side (so seams are not meshed) and the strip's rows
+    within it; for a memmap, a (file, offset, shape, dtype) reference the worker maps itself
+    """
+    a, b = max(i - 1, 0), min(j + 1, cloud.shape[0])
+    core = (i - a, min(j, cloud.shape[0]) - a)
+    if not (isinstance(cloud, num.memmap) and cloud.filename): return cloud[a:b], core
+    return (cloud.filename, cloud.offset + a*cloud.strides[0], (b - a, *cloud.shape[1:]), cloud.dtype), core
+
+# per face (left, right, bottom, top, back, front): 4 corner offsets, then the normal
+FACES = num.array([
+    [[0, 0, 0], [0, 0, 1], [0, 1, 1], [0, 1, 0], [-1, 0, 0]],
+    [[1, 0, 0], [1, 1, 0], [1, 1, 1], [1, 0, 1], [1, 0, 0]],
+    [[0, 0, 0], [1, 0, 0], [1, 0, 1], [0, 0, 1], [0, -1, 0]],
+    [[0, 1, 0], [0, 1, 1], [1, 1, 1], [1, 1, 0], [0, 1, 0]],
+    [[0, 0, 0], [0, 1, 0], [1, 1, 0], [1, 0, 0], [0, 0, -1]],
+    [[0, 0, 1], [1, 0, 1], [1, 1, 1], [0, 1, 1], [0, 0, 1]],
+], dtype=num.int8)
+# uint8 as trimesh would round COL: same GLB, a quarter of the bytes sent back from workers
+RGB = num.round(num.array([COL.get(KINDS[k], (0, 0, 0)) for k in sorted(KINDS)])*255).astype(num.uint8)
+
+def _merge(exposed, normal):
+    """
+    Greedy rectangles (start, extent, kind) over the exposed face kinds of one direction:
+    same-kind faces are merged into runs along one in-plane axis, then runs with the same
+    ends and kind are merged across consecutive rows of the other
+    """
+    n = int(num.flatnonzero(normal)[0]); u, v = [axis for axis in range(3) if axis != n]
+    grid = exposed.transpose(n, v, u)  # (plane, row, along)
+    rows = grid.reshape(-1, grid.shape[2])
+    pad = num.zeros((len(rows), 1), dtype=rows.dtype)
+    starts = (rows != 0) & (rows != num.hstack([pad, rows[:, :-1]]))
+    ends = (rows != 0) & (rows != num.hstack([rows[:, 1:], pad]))
+    row, u0 = num.nonzero(starts); u1 = num.nonzero(ends)[1] + 1
+    kind = rows[row, u0]
+    plane, r = num.divmod(row, grid.shape[1])
+
+    # runs of consecutive rows with identical (plane, u0, u1, kind) become one rectangle
+    order = num.lexsort((r, kind, u1, u0, plane))
+    plane, r, u0, u1, kind = plane[order], r[order], u0[order], u1[order], kind[order]
+    key = num.column_stack([plane, u0, u1, kind])
+    new = num.ones(len(r), dtype=bool)
+    new[1:] = (key[1:] != key[:-1]).any(axis=1) | (r[1:] != r[:-1] + 1)
+    first = num.flatnonzero(new); last = num.append(first[1:], len(r))[:len(first)] - 1  # none if no faces
+
+    start, extent = num.zeros((len(first), 3), dtype=int), num.ones((len(first), 3), dtype=int)
+    start[:, n], start[:, v], start[:, u] = plane[first], r[first], u0[first]
+    extent[:, v], extent[:, u] = r[last] - r[first] + 1, u1[first] - u0[first]
+    return start, extent, kind[first]
+
+# rows per quad and dtype of each mesh array: vertices, faces, normals, colors (dtypes as
+# trimesh stores them, so it takes vertices and faces without converting)
+LAYOUT = ((4, num.float64), (2, num.int64), (4, num.int8), (4, num.uint8))
+
+def _arrays(n, buffers=None):
+    """Mesh arrays for n quads, over buffers (e.g. shared memory) if given"""
+    if buffers is None: return [num.empty((k*n, 3), dtype) for k, dtype in LAYOUT]
+    return [num.ndarray((k*n, 3), dtype, buffer=b) for (k, dtype), b in zip(LAYOUT, buffers)]
+
+def _expand(quads, out, at=0, origin=(0, 0, 0)):
+    """
+    Writes quads (face, start, extent, kind), moved by origin, into the mesh arrays out from
+    quad at on: 4 vertices and 2 triangles each, indexing all of out
+    """
+    face, start, extent, kind = quads
+    vertices, faces, normals, colors = out
+    n = len(face); v = slice(4*at, 4*(at + n))
+    # corner = start + offset*extent: unit faces stretched over their rectangle
+    vertices[v] = ((start + origin)[:, None] + FACES[face, :4] * extent[:, None]).reshape(-1, 3)
+    i = 4*num.arange(at, at + n)[:, None]
+    faces[2*at:2*(at + n)] = num.hstack([i, i + 1, i + 2, i, i + 2, i + 3]).reshape(-1, 3)
+    normals[v] = num.repeat(FACES[face, 4], 4, axis=0)
+    colors[v] = num.repeat(RGB[kind], 4, axis=0)
+
+def _mesh(quads, origin=(0, 0, 0)):
+    out = _arrays(len(quads[0])); _expand(quads, out, 0, origin)
+    return out
+
+def _quads(stripData, greedy=False):
+    """
+    Exposed faces of a strip's voxels as (face, start, extent, kind) rectangles, from the
+    strip's first row; greedy merges coplanar same-kind faces (see _merge)
+    """
+    strip, (a, b) = stripData
+    if isinstance(strip, tuple):  # read through the page cache, no pickled copy
+        file, offset, shape, dtype = strip
+        strip = num.memmap(file, dtype, "r", offset, shape)
+    strip = num.asarray(strip)
+    solid = num.pad(strip != 0, 1)  # outside the cloud is empty
+
+    quads = []
+    for face, normal in enumerate(FACES[:, 4]):
+        # a face is exposed where the voxel is solid and its neighbour along normal is not
+        nx, ny, nz = (1 + normal).tolist()
+        neighbour = solid[nx:nx + strip.shape[0], ny:ny + strip.shape[1], nz:nz + strip.shape[2]]
+        exposed = (strip[a:b] != 0) & ~neighbour[a:b]
+        if greedy: start, extent, kind = _merge(num.where(exposed, strip[a:b], 0), normal)
+        else:
+            start = num.argwhere(exposed); kind = strip[a:b][exposed]
+            extent = num.ones_like(start)
+        quads.append((num.full(len(start), face, dtype=num.uint8), start, extent, kind))
+    face, start, extent, kind = (num.concatenate(q) for q in zip(*quads))
+    return face, start.astype(num.int32), extent.astype(num.int32), kind
+
+def march(stripData, greedy=False):
+    """Exposed faces of a strip's voxels as (vertices, faces, normals, colors) arrays"""
+    strip, origin = stripData
+    return _mesh(_quads(strip, greedy), origin)
+
+STRIP = 32  # most rows per strip: the unit re-meshed after an edit
+QUAD = num.dtype([("face", num.uint8), ("start", num.int32, 3), ("extent", num.int32, 3), ("kind", num.uint8)])
+
+@define
+class Strips:
+    """
+    Quads of each strip of the last build, keyed by a hash of the strip's voxels (halo rows
+    included, as they decide which faces are exposed): rebuilding after an edit re-meshes
+    only the strips the edit touched. The quads stay in the shared memory segment the worker
+    wrote them to: quads[key] = (segment name, quad count)
+    """
+    quads: Dict[bytes, Tuple[str, int]] = field(factory=dict)
+    hits: int = 0
+    misses: int = 0
+
+    @staticmethod
+    def key(cloud, i, j, greedy) -> bytes:
+        a, b = max(i - 1, 0), min(j + 1, cloud.shape[0])
+        digest = blake2b(repr((cloud.shape, a - i, b - i, greedy)).encode(), digest_size=16)
+        digest.update(num.ascontiguousarray(cloud[a:b])); return digest.digest()
+
+    def keep(self, keys):
+        """Release every strip but keys'"""
+        for key in self.quads.keys() - set(keys): _release(self.quads.pop(key)[0])
+
+    def clear(self):
+        self.keep(())
+
+STRIPS = Strips()  # shared by builds in this process
+register(STRIPS.clear)
+
+def _release(name):
+    shm = SharedMemory(name=name); shm.close(); shm.unlink()
+
+def _stash(stripData, greedy=False) -> Tuple[str, int]:
+    """A strip's quads, written to a new shared segment: (its name, quad count)"""
+    face, start, extent, kind = _quads(stripData, greedy)
+    shm = SharedMemory(create=True, size=max(1, len(face)*QUAD.itemsize))
+    rec = num.ndarray(len(face), QUAD, buffer=shm.buf)
+    rec["face"], rec["start"], rec["extent"], rec["kind"] = face, start, extent, kind
+    del rec; shm.close()
+    return shm.name, len(face)
+
+_worker = {}
+def _attach(names, n):
+    shm = [SharedMemory(name=name) for name in names]
+    _worker.update(shm=shm, out=_arrays(n, [s.buf for s in shm]))
+
+def _write(job):
+    (name, n), at, origin = job
+    shm = SharedMemory(name=name)
+    rec = num.ndarray(n, QUAD, buffer=shm.buf)
+    _expand(tuple(rec[f] for f in QUAD.names), _worker["out"], at, origin)
+    del rec; shm.close()
+
+@contextmanager
+def process(cloud, callback, greedy=False, cache=STRIPS):
+    """
+    Mesh arrays of a kind volume, meshed by strips in a pool: workers first write the
+    rectangles of each strip not in cache to shared memory and return only their counts,
+    which size the shared mesh arrays; then each worker expands its strips' quads into
+    vertices and (already offset) triangles in place. The arrays are views of shared memory,
+    released on exit
+    """
     cores = cpu_count()
-    stripSize = max(1, cloud.shape[0] // cores)
+    stripSize = max(1, min(STRIP, cloud.shape[0] // cores))
+    rows = range(0, cloud.shape[0], stripSize)
+    keys = [cache.key(cloud, i, i + stripSize, greedy) for i in rows]
+    todo = list({key: s for s, key in enumerate(keys) if key not in cache.quads}.values())
+
+    if todo:
+        resource_tracker.ensure_running()  # workers' segments outlive them: track them here
+        with Pool(min(cores, len(todo))) as pool:
+            strips = (_strip(cloud, rows[s], rows[s] + stripSize) for s in todo)
+            for done, (s, q) in enumerate(zip(todo, pool.imap(partial(_stash, greedy=greedy), strips)), 1):
+                cache.quads[keys[s]] = q; callback(0.5*done/len(todo))
+    cache.hits, cache.misses = len(keys) - len(todo), len(todo)
+    cache.keep(keys)  # this build's only
+    quads = [cache.quads[key] for key in keys]
+    counts = [n for _, n in quads]
+    at, n = num.cumsum([0] + counts[:-1]).tolist(), sum(counts)
+
+    shm, out = [], []
+    try:
+        for k, dtype in LAYOUT: shm.append(SharedMemory(create=True, size=max(1, k*n*3*num.dtype(dtype).itemsize)))
+        with Pool(cores, _attach, ([s.name for s in shm], n)) as pool:
+            jobs = zip(quads, at, ((i, 0, 0) for i in rows))
+            for done, _ in enumerate(pool.imap_unordered(_write, jobs), 1):
+                callback(0.5 + 0.5*done/len(rows))
+        out += _arrays(n, [s.buf for s in shm])
+        yield out
+    finally:
+        out.clear()  # drop the views, so the segments can be unmapped
+        for s in shm: s.unlink()
+        for s in shm: s.close()  # BufferError if a caller still holds a view
+
+def stack(runs: Runs):
+    """Mesh arrays (vertices, faces, normals, colors) of a Runs scene, no voxel expansion"""
+    cols = runs.cols()
+    z0, z1 = runs.z0.astype(int), runs.z1.astype(int)
+    prv = num.insert(z1[:-1], 0, -1)
+    same = num.append(cols[1:] == cols[:-1], False)
+    quads = []  # (face, run, lo, hi): the run's side from z = lo to hi
+    for face, (dx, dy) in enumerate([(-1, 0), (1, 0), (0, -1), (0, 1)]):
+        run, lo, hi = runs.sides(cols, dx, dy)
+        quads.append((num.full(len(run), face), run, lo, hi))
+    top = runs.tops(cols)
+    bottom = num.flatnonzero(~(num.insert(same[:-1], 0, False) & (prv == z0)))
+    quads.append((num.full(len(bottom), 4), bottom, z0[bottom], z0[bottom] + 1))
+    quads.append((num.full(len(top), 5), top, z1[top] - 1, z1[top]))
+    face, run, lo, hi = (num.concatenate(q) for q in zip(*quads))
+
+    _, Y, _ = runs.shape
+    start = num.column_stack([cols[run] // Y, cols[run] % Y, lo])
+    extent = num.column_stack([num.ones_like(lo), num.ones_like(lo), hi - lo])
+    return _mesh((face, start, extent, runs.kinds[run]))
+
+# 2.5D scene: column (x, y) is kinds[x, y] from the floor up to heights[x, y]
+Heightfield = data("Heightfield", "kinds heights")
+
+def _labels(field: Heightfield):
+    """
+    (face, normal, label) of the tops and side walls: label is an (X, Y) grid of each
+    column's face packed as bottom << 24 | top << 8 | kind (0: no face), so that faces merge
+    only where all three match
+    """
+    kinds, heights = num.asarray(field.kinds), num.asarray(field.heights).astype(int)
+    heights = num.where(kinds != 0, heights, 0)
+    X, Y = heights.shape
+    padded = num.pad(heights, 1)
+
+    labels = []
+    for face, normal in enumerate(FACES[:, 4]):
+        dx, dy, dz = normal.tolist()
+        if dz < 0: continue  # floor faces are never visible
+        if dz: label = num.where(heights > 0, heights << 8 | kinds, 0)
+        else:  # walls from the lower neighbour's height up
+            below = padded[1 + dx:1 + dx + X, 1 + dy:1 + dy + Y]
+            label = num.where(heights > below, below << 24 | heights << 8 | kinds, 0)
+        labels.append((face, normal, label))
+    return labels
+
+def _rects(labels, greedy=True, x=slice(None), y=slice(None)):
+    """Quads (face, start, extent, kind) of the labelled faces in columns [x, y]"""
+    rects = []
+    for face, normal, whole in labels:
+        label = whole[x, y]
+        if greedy: start, extent, key = _merge(label[..., None], normal)
+        else:
+            start = num.argwhere(label[..., None]); key = label[label != 0]
+            extent = num.ones_like(start)
+        kind, top = key & 0xFF, key >> 8 & 0xFFFF
+        if normal[2]: start[:, 2] = top - 1
+        else: start[:, 2], extent[:, 2] = key >> 24, top - (key >> 24)
+        start[:, :2] += [x.start or 0, y.start or 0]
+        rects.append((num.full(len(start), face), start, extent, kind))
+    return [num.concatenate(r) for r in zip(*rects)]
 
-    strips = []
-    for i in range(0, cloud.shape[0], stripSize):
-        strip = cloud[i:i+stripSize]
-        strips.append((strip, (i, 0, 0)))
+def terrain(field: Heightfield, greedy=True):
+    """
+    Mesh arrays of a heightfield from the 2D grids alone: column tops, plus side walls from
+    the lower neighbour's height up (floor faces are skipped: they are never visible)
+    """
+    return _mesh(_rects(_labels(field), greedy))
 
-    with Manager() as manager:
-        status = manager.dict()
+def _coarse(field: Heightfield, f):
+    """field with each f x f block of columns merged into one: its tallest column"""
+    kinds = num.asarray(field.kinds); heights = num.where(kinds != 0, field.heights, 0)
+    X, Y = heights.shape; pad = ((0, -X % f), (0, -Y % f))
+    blocks = lambda a: (num.pad(a, pad).reshape(-(-X // f), f, -(-Y // f), f)
+        .transpose(0, 2, 1, 3).reshape(-(-X // f), -(-Y // f), f*f))
+    kinds, heights = blocks(kinds), blocks(heights)
+    top = heights.argmax(axis=2)[..., None]
+    return Heightfield(num.take_along_axis(kinds, top, 2)[..., 0], num.take_along_axis(heights, top, 2)[..., 0])
 
-        with Pool(cores) as pool:
-            fn = partial(march, status=status)
-            results = pool.map_async(fn, enumerate(strips))
+TILE = 64  # tile edge, in columns
+LODS = (1, 4)  # per level of detail: columns merged per tile side (1: full detail)
 
-            while not results.ready():
-                completed = sum(status.values())
-                callback(completed / cores * 0.8)
-                results.wait(0.1)
+def pyramid(field: Heightfield, out, size=TILE, lods=LODS, greedy=True):
+    """
+    Tiled export of a heightfield: size x size column tiles, meshed once per level of detail,
+    to out/tiles/{level}/{x}_{y}.glb (empty tiles are skipped), listed with their bounds,
+    triangle counts and content hashes in out/tiles/manifest.json
+    """
+    X, Y = field.heights.shape
+    root = path.join(out, "tiles")
+    rmtree(root, ignore_errors=True)  # no stale tiles from a larger scene
+    heights = num.where(num.asarray(field.kinds) != 0, field.heights, 0)
 
-            results = results.get()
+    tiles = {}
+    for level, f in enumerate(lods):
+        assert size % f == 0, "tiles must split into whole merged columns"
+        labels, step = _labels(field if f == 1 else _coarse(field, f)), size // f
+        makedirs(path.join(root, str(level)))
+        for i, j in num.ndindex(-(-X // size), -(-Y // size)):
+            quads = _rects(labels, greedy, slice(i*step, (i + 1)*step), slice(j*step, (j + 1)*step))
+            if not len(quads[0]): continue
+            _, start, extent, _ = quads
+            end = num.minimum((start + extent)[:, :2]*f, [X, Y])  # last merged columns may overhang
+            start[:, :2] *= f; extent[:, :2] = end - start[:, :2]
+            v, t, n, c = _mesh(quads)
+            glb = trimesh.Trimesh(v, t, vertex_normals=n, vertex_colors=c).export(file_type="glb")
+            with open(path.join(root, str(level), f"{i}_{j}.glb"), "wb") as file: file.write(glb)
 
-    offset = 0
-    for _vertices, _faces, _normals, _colors in results:
-        vertices.extend(_vertices)
-        faces.extend([[f[0] + offset, f[1] + offset, f[2] + offset] for f in _faces])
-        normals.extend(_normals)
-        colors.extend(_colors)
-        offset += len(_vertices)
+            x, y = slice(i*size, (i + 1)*size), slice(j*size, (j + 1)*size)
+            tile = tiles.setdefault((i, j), {"x": i, "y": j, "levels": {},
+                "bounds": [[x.start, y.start, 0], [min(x.stop, X), min(y.stop, Y), int(heights[x, y].max())]]})
+            tile["levels"][level] = {"triangles": len(t), "bytes": len(glb),
+                "hash": blake2b(glb, digest_size=8).hexdigest()}
 
-def build(cloud, out, callback):
-    callback(0.0, "Marching cubes")
-    process(cloud, lambda p: callback(p*0.8))
+    manifest = {"tile": size, "shape": [X, Y], "lods": list(lods), "tiles": list(tiles.values())}
+    with open(path.join(root, "manifest.json"), "w") as file: json.dump(manifest, file)
+    return manifest
 
-    callback(0.8, "Creating mesh")
-    mesh = trimesh.Trimesh(vertices, faces, vertex_normals=normals, vertex_colors=colors)
+def build(cloud, out, callback, greedy=True, tiles: Heightfield | None = None):
+    """
+    cloud: a kind volume, Runs (meshed directly: side faces span whole runs) or a
+    Heightfield (meshed from the 2D grids, no pool).
+    greedy: merge coplanar same-kind voxel faces into rectangles.
+    tiles: also export this Heightfield (the scene's top view) as tiles with levels of
+    detail (see pyramid); the scene mesh itself stays whatever cloud is.
+    A volume is re-meshed only in the strips that changed since the last build (see Strips).
+    The final callback reports the triangle count, GLB size and build time
+    """
+    start = time(); extra = {}
+    if isinstance(cloud, Heightfield):
+        callback(0.0, "Meshing heightfield")
+        v, f, n, c = terrain(cloud, greedy)
+        mesh = trimesh.Trimesh(v, f, vertex_normals=n, vertex_colors=c)
+    elif isinstance(cloud, Runs):
+        callback(0.0, "Meshing runs")
+        v, f, n, c = stack(cloud)
+        mesh = trimesh.Trimesh(v, f, vertex_normals=n, vertex_colors=c)
+    else:
+        callback(0.0, "Marching cubes")
+        with process(cloud, lambda p: callback(p*0.8), greedy) as arrays:
+            callback(0.8, "Creating mesh")
+            v, f, n, c = arrays
+            mesh = trimesh.Trimesh(v, f, vertex_normals=n, vertex_colors=c)
+            del v, f, n, c
+        extra.update(strips=STRIPS.hits + STRIPS.misses, remeshed=STRIPS.misses)
 
     callback(0.9, "Exporting")
     mesh.export(f"{out}/scene.glb")
+    if tiles is not None:
+        callback(0.95, "Exporting tiles")
+        extra.update(tiles=len(pyramid(tiles, out, greedy=greedy)["tiles"]))
 
-    callback(1.0, "Finished")
+    info = dict(triangles=len(mesh.faces), bytes=path.getsize(f"{out}/scene.glb"), seconds=round(time() - start, 2), **extra)
+    callback(1.0, "Finished: {triangles} triangles, {bytes} bytes in {seconds}s".format(**info), **info)
@@ -1,22 +1,29 @@
 from gen.proc import *
 from gen.place import *
 from sim.signal import *
+from sim.cache import LinkCache
+from sim.links import Links
+from sim.artifacts import Artifacts
 from sim import rep
-from gen.build import build
+from gen.build import build, Heightfield
 from typing import *  # type: ignore
 from attrs import define, Factory as new
 import matplotlib.pyplot as plot
 from os import getcwd as cwd, path, mkdir
 from contextlib import asynccontextmanager
-from fastapi import FastAPI
+from fastapi import FastAPI, Body, HTTPException, Request, Response
+from fastapi.responses import FileResponse
 from fastapi.middleware.cors import CORSMiddleware
 from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import cpu_count
 from time import time
 from rich import print
 from sys import stderr
-from threading import Thread
+from threading import Thread, Lock
 from uvicorn import run
 import toml
+import random
+import json
 
 config = toml.load("config.toml")
 
@@ -29,50 +36,111 @@ class Timer:
 
 progress = {
     "signal": {"value": 0.0, "step": "Waiting for nodes"},
-    "build":  {"value": 0.0, "step": "Initializing"}
+    "build":  {"value": 0.0, "step": "Initializing"},
+    "cache":  {}  # stage -> "hit" | "miss" (artifact cache, seeded runs only)
 }
 timer = Timer()
+ASSETS = path.join(cwd(), "vis", "assets")  # scene.glb and tiles, served to the frontend
+building = Lock()  # held while main builds the scene and while an edit re-meshes it
+links: Links | None = None  # incremental LINKS for scene edits, made on the first one
 
-def updateProgress(task, value, step=None, log=True):
+def updateProgress(task, value, step=None, log=True, **info):
     global progress
     progress[task]["value"] = value
+    progress[task].update(info)  # e.g. cache hit rate
     if step:
         progress[task]["step"] = step
         if log: print(f"[bright_yellow][{timer}][/]  {step}")
 
-def main(width=60, depth=80, n_nodes=None, comm_type="BLE"):
-    global W, D
-    W, D = width, depth
-    rep.TYPE = comm_type
-    plot.rcParams["toolbar"] = "None"
-
-    updateProgress("build", 0.0, "Generating layout")
-    regions = genRegions(W, D, show=False)  # generate warehouse layout
+def artifacts(seed, **config) -> Artifacts | None:
+    """Seeds both random streams and opens the artifact store (a seeded scene is reproducible)"""
+    if seed is None: return None
+    random.seed(seed); num.random.seed(seed)
+    store = Artifacts.of(config, seed)
+    for stage in ("scene", "links", "mesh"): progress["cache"][stage] = "hit" if store.has(stage) else "miss"
+    return store
 
-    try:
-        updateProgress("build", 0.05, "Placing features")
-        kinds: Grid = features(W, D, regions, FREQ)  # place features
+def cached(store, stage) -> bool:
+    return store is not None and store.has(stage)
 
-        updateProgress("build", 0.1, "Scattering nodes")
-        nodes: Grid = rep.genPoints(W, D, n=n_nodes)  # scatter nodes
-        plot.close()
+def makeScene(store, n_nodes, tiles, **opts):
+    """Loads the cached scene or generates one; opts (table, out, dense) go to rep.load / init"""
+    if cached(store, "scene"):
+        updateProgress("build", 0.15, "Loading cached scene")
+        rep.load(store.dir, **opts)
+        return
 
-        updateProgress("build", 0.15, "Creating internal representation")
-        rep.init(kinds, nodes, show=False)  # create scene rep in global rep.SCENE
-        plot.pause(0.1)
+    updateProgress("build", 0.0, "Generating layout")
+    regions = genRegions(W, D, show=False)  # generate warehouse layout
 
-        def runBuild():
-            out = path.join(cwd(), "vis", "assets")
-            if not path.exists(out): mkdir(out)
-            build(rep.cloud, out, lambda v, s=None: updateProgress("build", 0.2 + v*0.8, s))
+    updateProgress("build", 0.05, "Placing features")
+    kinds: Grid = features(W, D, regions, FREQ)  # place features
+
+    updateProgress("build", 0.1, "Scattering nodes")
+    nodes: Grid = rep.genPoints(W, D, n=n_nodes, tiles=tiles)  # scatter nodes
+    plot.close()
+
+    updateProgress("build", 0.15, "Creating internal representation")
+    rep.init(kinds, nodes, show=False, **opts)  # create scene rep in global rep.SCENE
+    plot.pause(0.1)
+    if store: rep.save(store.dir); store.done("scene")
+
+def meshed():
+    """
+    What build meshes: the 2D grids while every column is at most one floor-up run (the
+    generated scenes), else the kind cloud if there is one (marched, greedy or not), else the
+    runs (stacked)
+    """
+    if not ((num.diff(rep.runs.ptr) > 1).any() or rep.runs.z0.any()):
+        return Heightfield(rep.SCENE.kinds, rep.heights)
+    return rep.cloud if rep.cloud is not None else rep.runs
+
+def runBuild(store, greedy, lod):
+    out = ASSETS
+    if not path.exists(out): mkdir(out)
+    files = [f"{out}/scene.glb"] + ([f"{out}/tiles"] if lod else [])
+    if cached(store, "mesh"):
+        store.get("mesh", *files)
+        updateProgress("build", 1.0, "Finished (cached)")
+        return
+    callback = lambda v, s=None, **info: updateProgress("build", 0.2 + v*0.8, s, **info)
+    top = Heightfield(rep.SCENE.kinds, rep.heights) if lod else None  # tiles are cut from the top view
+    build(meshed(), out, callback, greedy, top)
+    if store: store.put("mesh", *files)
+
+def runSigStren(store):
+    if cached(store, "links"):
+        rep.LINKS.load(store.dir)
+        updateProgress("signal", 1.0, "Connections made (cached)")
+        return
+    callback = lambda v, s=None, log=True, **info: updateProgress("signal", v, s, log, **info)
+    kinds = rep.cloud if rep.cloud is not None else rep.runs  # not dense: run-length columns only
+    code = rep.COMMS.index(getattr(rep, rep.TYPE))
+    if code in TECHS and len(TECHS) > 1:  # other measured technologies: all of them in one pass
+        techStren(kinds, rep.MESH, callback, TECHS, links={code: rep.LINKS})
+    else:
+        scene = rep.atten if rep.atten is not None else kinds  # atten only if opted in
+        sigStren(scene, rep.MESH, callback, procs=cpu_count(), cache=LinkCache.of(scene))
+    if store: rep.LINKS.save(store.dir); store.done("links")
+
+def main(width=60, depth=80, n_nodes=None, comm_type="BLE", tiles=False, seed=None, out=None,
+    dense=True, greedy=True, lod=False, atten=False):
+    global W, D, links
+    W, D = width, depth
+    links = None
+    rep.TYPE = comm_type
+    plot.rcParams["toolbar"] = "None"
 
-        def runSigStren():
-            callback = lambda v, s=None, log=True: updateProgress("signal", v, s, log)
-            sigStren(rep.cloud, rep.MESH, callback)
+    store = artifacts(seed, width=W, depth=D, nodes=n_nodes, comm=comm_type, tiles=tiles,
+        dense=dense, greedy=greedy, lod=lod, atten=atten)
+    table = ATTEN if atten else None  # opt-in float32 loss volume: 4x the uint8 cloud
 
-        with ThreadPoolExecutor() as executor:
-            executor.submit(runBuild)
-            executor.submit(runSigStren)
+    try:
+        with building:
+            makeScene(store, n_nodes, tiles, table=table, out=out, dense=dense)
+            with ThreadPoolExecutor() as executor:
+                executor.submit(runBuild, store, greedy, lod)
+                executor.submit(runSigStren, store)
 
     except Exception as e:
         print(f"[bright_red][{timer}]  ERROR: {e}[/]", file=stderr)
@@ -81,7 +149,7 @@ def main(width=60, depth=80, n_nodes=None, comm_type="BLE"):
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    kwargs = {k: config[k] for k in ["width", "depth", "nodes", "comm"] if k in config}
+    kwargs = {k: config[k] for k in ["width", "depth", "nodes", "comm", "tiles", "seed", "out", "dense", "greedy", "lod", "atten"] if k in config}
     Thread(target=main, kwargs=kwargs).start()
     app.MESH = rep.MESH  # type: ignore
     yield
@@ -110,7 +178,55 @@ def getRoot():
 
 @app.get("/controllers")
 async def controllers():
-    return [x.toJson() for x in app.MESH.values()]  # type: ignore
+    return app.MESH.toJson()  # type: ignore
+
+@app.post("/scene/edit")
+def editScene(voxels: List[Tuple[int, int, int, int]] = Body(embed=True)):
+    """
+    Set voxels [[x, y, z, kind], ...] of a dense scene, re-trace the links crossing them and
+    re-export scene.glb: only the strips they touch are marched again (tiles, if lod, are
+    re-cut from the top view). 409 while the scene is being built or edited
+    """
+    global links
+    if not building.acquire(blocking=False): raise HTTPException(409, "Scene is being built")
+    try:
+        if getattr(rep, "cloud", None) is None: raise HTTPException(409, "Scene is not dense (set dense = true)")
+        try: rep.edit(voxels)
+        except (IndexError, ValueError) as e: raise HTTPException(422, str(e)) from e
+        scene = rep.atten if rep.atten is not None else rep.cloud  # edited in place, as sigStren traced it
+        if links is None: links = Links(scene, rep.MESH)  # traces every pair once
+        else: links.edit([v[:3] for v in voxels])
+        runBuild(None, config.get("greedy", True), config.get("lod", False))
+        return progress["build"]
+    finally:
+        building.release()
+
+# tiles are revalidated on every use (their URLs outlive a rebuild): ETag hits cost a 304
+REVALIDATE = {"Cache-Control": "public, no-cache"}
+
+manifest = {"mtime": None, "etags": {}}  # (level, x, y) -> ETag, reloaded with manifest.json
+
+def tileManifest() -> str:
+    file = path.join(ASSETS, "tiles", "manifest.json")
+    if not path.exists(file): raise HTTPException(404, "No tiles (set lod = true)")
+    if manifest["mtime"] != path.getmtime(file):
+        with open(file) as f: tiles = json.load(f)["tiles"]
+        manifest.update(mtime=path.getmtime(file), etags={(int(level), t["x"], t["y"]): f'"{h["hash"]}"'
+            for t in tiles for level, h in t["levels"].items()})
+    return file
+
+@app.get("/tiles/manifest")
+def getManifest():
+    return FileResponse(tileManifest(), headers=REVALIDATE)
+
+@app.get("/tiles/{level}/{x}/{y}")
+def getTile(level: int, x: int, y: int, request: Request):
+    tileManifest(); etag = manifest["etags"].get((level, x, y))
+    if etag is None: raise HTTPException(404, "No such tile")
+    headers = {"ETag": etag, **REVALIDATE}
+    if request.headers.get("if-none-match") == etag: return Response(status_code=304, headers=headers)
+    file = path.join(ASSETS, "tiles", str(level), f"{x}_{y}.glb")
+    return FileResponse(file, media_type="model/gltf-binary", headers=headers)
 
 if __name__ == "__main__":
     run("__main__:app", host="localhost", port=8001, reload=False, log_level="critical")
@@ -0,0 +1,64 @@
+from attrs import define
+from typing import *
+from hashlib import blake2b
+from os import path, makedirs, listdir
+from shutil import copyfile, copytree
+
+"""
+Content-addressed cache of generated scenes so a restart with the same config skips
+generation entirely
+
+A scene is keyed by the config that shaped it, the seed and VERSION (a hash of the gen and
+sim sources). Each stage writes its files into the scene's directory and then a marker, so
+a stage counts as cached only once it finished:
+    scene   kinds, heights, runs and the fleet (rep.save / rep.load)
+    links   rep.LINKS (LinkMatrix.save / load)
+    mesh    scene.glb (and the tiles directory, if exported)
+
+store = Artifacts.of({"width": 60, "depth": 80}, seed=0)
+if store.has("scene"): rep.load(store.dir)
+else: rep.init(...); rep.save(store.dir); store.done("scene")
+"""
+
+SCENES = path.join(".cache", "scenes")
+
+def _version() -> str:
+    digest = blake2b(digest_size=8)
+    base = path.dirname(path.dirname(path.abspath(__file__)))
+    for pkg in ("gen", "sim"):
+        for file in sorted(listdir(path.join(base, pkg))):
+            if file.endswith(".py"):
+                with open(path.join(base, pkg, file), "rb") as f: digest.update(f.read())
+    return digest.hexdigest()
+
+VERSION = _version()
+
+@define
+class Artifacts:
+    dir: str
+
+    @classmethod
+    def of(cls, config: Dict[str, Any], seed, root=SCENES):
+        key = repr((sorted(config.items()), seed, VERSION)).encode()
+        scene = path.join(root, blake2b(key, digest_size=16).hexdigest())
+        makedirs(scene, exist_ok=True)
+        return cls(scene)
+
+    def has(self, stage) -> bool:
+        return path.exists(path.join(self.dir, f"{stage}.done"))
+
+    def done(self, stage):
+        open(path.join(self.dir, f"{stage}.done"), "w").close()
+
+    def put(self, stage, *files):
+        """Store finished files or directories (e.g. scene.glb) as the stage's artifacts"""
+        for file in files: _copy(file, path.join(self.dir, path.basename(file)))
+        self.done(stage)
+
+    def get(self, stage, *files):
+        """Copy a stage's artifacts to files"""
+        for file in files: _copy(path.join(self.dir, path.basename(file)), file)
+
+def _copy(src, dst):
+    if path.isdir(src): copytree(src, dst, dirs_exist_ok=True)
+    else: copyfile(src, dst)
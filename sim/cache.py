@@ -0,0 +1,97 @@
+from attrs import define, field
+import numpy as num
+from typing import *
+from numpy.typing import NDArray
+from hashlib import blake2b
+from os import path, makedirs, replace, remove, utime, listdir
+from .rep import Runs
+from .signal import ATTEN, MAX_STREN
+
+"""
+On-disk cache of link strengths so that restarts with an unchanged scene skip ray casting
+
+Each scene (content hash of the volume handed to sigStren, the attenuation table and
+MAX_STREN) gets one .npy table of REC records under CACHE, sorted by a hash of the pair's
+endpoint coordinates. Dead links are kept too (stren = -inf) so they are not re-cast.
+Least recently used tables are evicted once the directory grows past LIMIT bytes.
+
+cache = LinkCache.of(rep.atten); sigStren(rep.atten, rep.MESH, callback, cache=cache)
+"""
+
+CACHE = path.join(".cache", "links")
+LIMIT = 256 << 20
+REC = num.dtype([("key", "<u8"), ("a", "<f4", 3), ("b", "<f4", 3), ("stren", "<f4")])
+
+def _key(a, b):
+    """FNV-1a over the endpoints' float32 bits"""
+    bits = num.hstack([a, b]).astype("<f4").view("<u4").astype(num.uint64)
+    key = num.full(len(bits), 0xCBF29CE484222325, dtype=num.uint64)
+    for col in bits.T: key = (key ^ col) * num.uint64(0x100000001B3)
+    return key
+
+@define
+class LinkCache:
+    file: str
+    limit: int = LIMIT
+    hits: int = 0
+    misses: int = 0
+    _table: NDArray = field(init=False)
+    _new: List[NDArray] = field(init=False, factory=list)
+
+    def __attrs_post_init__(self):
+        if path.exists(self.file):
+            self._table = num.load(self.file, mmap_mode="r")
+            utime(self.file)  # recently used
+        else: self._table = num.zeros(0, dtype=REC)
+
+    @classmethod
+    def of(cls, scene, root=CACHE, limit=LIMIT):
+        digest = blake2b(digest_size=16)
+        arrays = [scene.ptr, scene.z0, scene.z1, scene.kinds] if isinstance(scene, Runs) else [scene]
+        digest.update(repr((scene.shape, [a.dtype.str for a in arrays], MAX_STREN)).encode())
+        digest.update(ATTEN.tobytes())
+        for a in arrays: digest.update(num.ascontiguousarray(a).data)
+        makedirs(root, exist_ok=True)
+        return cls(path.join(root, f"{digest.hexdigest()}.npy"), limit)
+
+    @property
+    def rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def lookup(self, a, b) -> Tuple[NDArray, NDArray]:
+        """(found, stren) for the rays a[i] -> b[i]"""
+        key, table = _key(a, b), self._table
+        found = num.zeros(len(key), dtype=bool)
+        stren = num.full(len(key), -num.inf, dtype=num.float32)
+        if len(table):
+            rec = table[num.minimum(num.searchsorted(table["key"], key), len(table) - 1)]
+            found = (rec["key"] == key) & (rec["a"] == num.asarray(a, num.float32)).all(axis=1) \
+                & (rec["b"] == num.asarray(b, num.float32)).all(axis=1)
+            stren[found] = rec["stren"][found]
+        self.hits += int(found.sum()); self.misses += int((~found).sum())
+        return found, stren
+
+    def store(self, a, b, stren):
+        if not len(stren): return  # all hits: nothing to write
+        rec = num.zeros(len(stren), dtype=REC)
+        rec["key"], rec["a"], rec["b"], rec["stren"] = _key(a, b), a, b, stren
+        self._new.append(rec)
+
+    def flush(self):
+        """Merge stored records into the scene's table, then evict old tables (if any were stored)"""
+        if not self._new: return
+        table = num.concatenate([self._table, *self._new])
+        self._table = table[num.argsort(table["key"], kind="stable")]; self._new = []
+        num.save(f"{self.file}.tmp.npy", self._table)
+        replace(f"{self.file}.tmp.npy", self.file)
+        self._evict()
+
+    def _evict(self):
+        root = path.dirname(self.file)
+        files = [path.join(root, f) for f in listdir(root) if f.endswith(".npy")]
+        files.sort(key=path.getmtime)  # oldest first
+        total = sum(map(path.getsize, files))
+        for f in files:
+            if total <= self.limit or f == self.file: continue
+            total -= path.getsize(f); remove(f)
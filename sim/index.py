@@ -0,0 +1,48 @@
+from attrs import define, field
+import numpy as num
+from typing import *
+from numpy.typing import NDArray
+from scipy.spatial import cKDTree as KDTree
+from .rep import Fleet
+
+"""
+Spatial index over controller positions for neighbour queries (e.g. link candidates)
+
+Built from any name -> Controller mapping (usually the rep.MESH Fleet, read straight from
+its pos array). Rows follow the mapping's iteration order, so row i is names[i] and pairs
+are returned as row indices.
+
+index = Index.of(rep.MESH); pairs = index.pairs(MAX_STREN)
+"""
+
+@define
+class Index:
+    names: List[str]
+    pos: NDArray = field(converter=lambda p: num.asarray(p, dtype=float).reshape(-1, 3))
+    _tree: KDTree = field(init=False)
+
+    def __attrs_post_init__(self):
+        self._tree = KDTree(self.pos)
+
+    @classmethod
+    def of(cls, mesh):
+        if isinstance(mesh, Fleet): return cls(list(mesh.names), mesh.pos)
+        return cls(list(mesh), [tuple(c.pos) for c in mesh.values()])
+
+    def pairs(self, r) -> NDArray:
+        """All (i, j), i < j, no farther than r apart"""
+        return self._tree.query_pairs(r, output_type="ndarray").reshape(-1, 2)
+
+    def around(self, pos, r) -> NDArray:
+        """(i, row) for every point pos[i] and row no farther than r apart"""
+        pos = num.asarray(pos, dtype=float).reshape(-1, 3)
+        found = KDTree(pos).sparse_distance_matrix(self._tree, r, output_type="ndarray")
+        return num.column_stack([found["i"], found["j"]]).astype(num.int64)
+
+    def within(self, pos, r) -> List[int]:
+        """Rows within r of pos"""
+        return sorted(self._tree.query_ball_point(tuple(pos), r))
+
+    def near(self, pos, r) -> List[str]:
+        """Names within r of pos"""
+        return [self.names[i] for i in self.within(pos, r)]
@@ -0,0 +1,117 @@
+from attrs import define, field
+import numpy as num
+from math import inf
+from typing import *
+from numpy.typing import NDArray
+from .index import Index
+from .rep import Coord, Fleet, LINKS
+from .signal import MAX_STREN, heightfield, trace, _canonical, _rays, _walk
+
+"""
+Keeps rep.LINKS (so Controller.hears) up to date after node moves and scene edits
+without a full sigStren
+
+Every candidate pair (endpoints within MAX_STREN) is kept, together with an inverted index
+from coarse voxel blocks (BLOCK^3 voxels) to the pairs whose rays cross them. A move only
+re-traces the moved nodes' pairs; an edit only re-traces the pairs crossing edited blocks.
+
+links = Links(rep.cloud, rep.MESH)
+links.move({"C001": (x, y, z)})
+rep.cloud[changed] = kind; links.edit(changed)  # Runs are replaced, not edited: edit(changed, rep.runs)
+"""
+
+BLOCK = 8  # power of two: block coords stay exact
+
+@define
+class Links:
+    cloud: Any  # kind volume, rep.atten (edited in place by the caller) or rep.runs
+    mesh: Dict[str, Any]
+    names: List[str] = field(init=False)
+    pos: NDArray = field(init=False)
+    pairs: NDArray = field(init=False)  # (P, 2) mesh rows
+    alive: NDArray = field(init=False)
+    _cells: NDArray = field(init=False)  # inverted index: block -> pair, as parallel arrays
+    _rays: NDArray = field(init=False)
+    _rows: Dict[str, int] = field(init=False)
+    _ids: NDArray = field(init=False)  # LINKS rows
+    _scene: Any = field(init=False)  # what rays are traced through (see signal.trace)
+
+    def __attrs_post_init__(self):
+        self._scene = heightfield(self.cloud) or self.cloud
+        index = Index.of(self.mesh)
+        self.names, self.pos = index.names, index.pos.copy()
+        self._rows = {name: i for i, name in enumerate(self.names)}
+        self._ids = LINKS.rows(self.names)
+        self.pairs = _canonical(index.pairs(MAX_STREN), self.pos).astype(num.int32)
+        self.alive = num.ones(len(self.pairs), dtype=bool)
+        self._cells, self._rays = num.zeros(0, num.int32), num.zeros(0, num.int32)
+
+        ids = num.arange(len(self.pairs))
+        self._register(ids); self._retrace(ids)
+
+    def move(self, moves: Dict[str, Any]):
+        """Set new positions and recompute only the moved nodes' links"""
+        rows = num.array([self._rows[n] for n in moves], dtype=num.int32)
+        self.pos[rows] = num.asarray(list(moves.values()), dtype=float).reshape(-1, 3)
+        if isinstance(self.mesh, Fleet): self.mesh.move(moves)
+        else:
+            for name, pos in moves.items(): self.mesh[name].pos = Coord(*pos)
+
+        # drop every old link of the moved nodes
+        old = num.flatnonzero(self.alive & num.isin(self.pairs, rows).any(axis=1))
+        LINKS.drop(*self._ids[self.pairs[old]].T)
+        self.alive[old] = False
+
+        index = Index(self.names, self.pos)
+        new = {(min(a, b), max(a, b)) for a in rows.tolist()
+            for b in index.within(self.pos[a], MAX_STREN) if a != b}
+        new = _canonical(num.array(sorted(new), dtype=num.int32).reshape(-1, 2), self.pos)
+
+        ids = num.arange(len(self.pairs), len(self.pairs) + len(new))
+        self.pairs = num.concatenate([self.pairs, new])
+        self.alive = num.concatenate([self.alive, num.ones(len(new), dtype=bool)])
+        self._register(ids); self._retrace(ids)
+        if self.alive.mean() < 0.5: self._compact()
+
+    def edit(self, voxels, cloud=None):
+        """
+        Recompute the links whose rays crossed any of the (already changed) voxels; cloud:
+        the edited scene, if the caller replaced it (e.g. rep.runs after rep.edit)
+        """
+        if cloud is not None: self.cloud = cloud
+        self._scene = heightfield(self.cloud) or self.cloud  # an edit may make or break columns
+        blocks = num.unique(self._block(num.asarray(voxels).reshape(-1, 3).T // BLOCK))
+        ids = num.unique(self._rays[num.isin(self._cells, blocks)])
+        self._retrace(ids[self.alive[ids]])
+
+    def _block(self, pos):
+        dims = -(-num.array(self.cloud.shape) // BLOCK)
+        return num.ravel_multi_index(pos, dims, mode="clip")  # clip: conservative
+
+    def _register(self, ids):
+        """Add the blocks crossed by pairs ids to the inverted index (coarse DDA)"""
+        A, B = self.pairs[ids].T
+        start, diff, ray = _rays(self.pos[A] / BLOCK, self.pos[B] / BLOCK)
+        cells, rays = [self._cells], [self._rays]
+        for idx, pos, t, _ in _walk(start, diff, ray, num.zeros(len(ray)), inf):
+            entered = t < ray[idx]
+            cells.append(self._block(pos[:, entered]).astype(num.int32))
+            rays.append(ids[idx[entered]].astype(num.int32))
+        self._cells, self._rays = num.concatenate(cells), num.concatenate(rays)
+
+    def _retrace(self, ids):
+        """Re-cast pairs ids and write the result into LINKS"""
+        pairs = self.pairs[ids]
+        loss = trace(self.pos[pairs[:, 0]], self.pos[pairs[:, 1]], self._scene, budget=MAX_STREN)
+        A, B = self._ids[pairs].T
+        live = loss <= MAX_STREN
+        LINKS.set(A[live], B[live], MAX_STREN - loss[live])
+        LINKS.drop(A[~live], B[~live])
+
+    def _compact(self):
+        """Forget dead pairs and renumber the index"""
+        remap = num.cumsum(self.alive, dtype=num.int32) - 1
+        keep = self.alive[self._rays]
+        self._cells, self._rays = self._cells[keep], remap[self._rays[keep]]
+        self.pairs = self.pairs[self.alive]
+        self.alive = num.ones(len(self.pairs), dtype=bool)
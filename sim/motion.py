@@ -0,0 +1,142 @@
+from attrs import define, field
+import numpy as num
+from typing import *
+from numpy.typing import NDArray
+from scipy import sparse
+from time import perf_counter as now
+from os import cpu_count
+from collections import deque
+from contextlib import ExitStack
+from .index import Index
+from .signal import MAX_STREN, heightfield, _pool, _traceOn
+
+"""
+Fixed-timestep simulation of mobile tags observed by the fixed controllers (rep.MESH)
+
+Tags follow looping waypoint paths at their own speed; positions advance for all tags at
+once. Every tick, each tag's links to the fixed controllers within MAX_STREN are found with
+one KD-tree query and traced in one batch, except for tags still in the voxel they were
+in last tick: those keep last tick's links. rssi is the (tags, controllers) strength matrix.
+Rays are traced on procs workers that attach the scene once, for the Motion's lifetime.
+
+tags = Tags.random(1000, rep.cloud.shape)
+with Motion(rep.cloud, rep.MESH, tags) as motion:
+    for _ in range(100): rssi = motion.step()
+    motion.timings[-1]  # {"move": .., "query": .., "trace": .., "total": .., "traced": ..}
+"""
+
+@define
+class Tags:
+    """M mobile tags walking paths[m] (K waypoints, looping) at speed[m] metres per second"""
+    paths: NDArray = field(converter=lambda p: num.asarray(p, dtype=float))  # (M, K, 3)
+    speed: NDArray = field(converter=lambda s: num.asarray(s, dtype=float))
+    seg: NDArray = field(init=False)  # current leg: paths[seg] -> paths[seg + 1]
+    along: NDArray = field(init=False)  # metres into the leg
+    pos: NDArray = field(init=False)
+    _moves: NDArray = field(init=False)  # paths of nonzero length
+
+    def __attrs_post_init__(self):
+        self.speed = num.broadcast_to(self.speed, len(self.paths)).copy()
+        self.seg = num.zeros(len(self.paths), dtype=int)
+        self.along = num.zeros(len(self.paths))
+        self.pos = self.paths[:, 0].copy()
+        legs = num.diff(self.paths, axis=1, append=self.paths[:, :1])
+        self._moves = (legs != 0).any(axis=(1, 2))
+
+    @classmethod
+    def random(cls, m, shape, k=4, z=1.0, speed=(0.5, 2.0)):
+        """m tags with k random waypoints at height z over an (x, y, ...) floor"""
+        paths = num.random.random((m, k, 3)) * [shape[0], shape[1], 0]
+        paths[..., 2] = z
+        return cls(paths, num.random.uniform(*speed, m))
+
+    def _leg(self):
+        k = self.paths.shape[1]; rows = num.arange(len(self.paths))
+        a, b = self.paths[rows, self.seg % k], self.paths[rows, (self.seg + 1) % k]
+        return a, b, num.sqrt(((b - a)**2).sum(axis=1))
+
+    def step(self, dt):
+        self.along += self.speed * dt
+        a, b, length = self._leg()
+        over = (self.along >= length) & self._moves
+        while over.any():  # fast tags may pass several (short) waypoints in one tick
+            self.along[over] -= length[over]; self.seg[over] += 1
+            a, b, length = self._leg()
+            over = (self.along >= length) & self._moves
+        with num.errstate(divide="ignore", invalid="ignore"):
+            frac = num.where(length > 0, self.along / length, 0)
+        self.pos = a + (b - a) * frac[:, None]
+
+TIMINGS = 1000  # ticks of timings kept
+
+@define
+class Motion:
+    cloud: NDArray  # kind volume or rep.atten
+    mesh: Any  # fixed controllers (rep.MESH)
+    tags: Tags
+    dt: float = 0.1
+    tick: int = 0
+    procs: int = field(factory=lambda: cpu_count() or 1)
+    timings: Deque[Dict[str, float]] = field(factory=lambda: deque(maxlen=TIMINGS))
+    rssi: sparse.csr_array = field(init=False)
+    _fixed: Index = field(init=False)
+    _scene: Any = field(init=False)
+    _voxel: NDArray = field(init=False)
+    _pool: Any = field(init=False, default=None)
+    _stack: ExitStack = field(init=False, factory=ExitStack)
+
+    def __attrs_post_init__(self):
+        self._fixed = Index.of(self.mesh)
+        self._scene = heightfield(self.cloud) or self.cloud
+        self.rssi = sparse.csr_array((len(self.tags.pos), len(self._fixed.names)), dtype=num.float32)
+        self._voxel = num.full(self.tags.pos.shape, -1)  # nothing traced yet
+        if self.procs > 1: self._pool = self._stack.enter_context(_pool(self._scene, self.procs))
+
+    def close(self):
+        """Stop the workers and release the shared scene"""
+        self._pool = None; self._stack.close()
+
+    def __enter__(self): return self
+
+    def __exit__(self, *exc): self.close()
+
+    @property
+    def names(self) -> List[str]:
+        """Controller of each rssi column"""
+        return self._fixed.names
+
+    def hears(self, tag) -> Dict[str, float]:
+        """Controllers that hear tag (a row of rssi) by name"""
+        a, b = self.rssi.indptr[tag], self.rssi.indptr[tag + 1]
+        return dict(zip([self.names[c] for c in self.rssi.indices[a:b]], self.rssi.data[a:b].tolist()))
+
+    def step(self) -> sparse.csr_array:
+        """Advance one tick and update rssi"""
+        t0 = now()
+        self.tags.step(self.dt)
+        voxel = num.floor(self.tags.pos).astype(int)
+        moved = num.flatnonzero((voxel != self._voxel).any(axis=1))
+        self._voxel = voxel
+        t1 = now()
+
+        pairs = self._fixed.around(self.tags.pos[moved], MAX_STREN)
+        tag, row = moved[pairs[:, 0]], pairs[:, 1]
+        t2 = now()
+
+        loss = _traceOn(self._pool, self.procs, self.tags.pos[tag], self._fixed.pos[row], self._scene)
+        live = loss <= MAX_STREN
+        t3 = now()
+
+        # tags that stayed in their voxel keep last tick's rows
+        old = self.rssi.tocoo()
+        kept = ~num.isin(old.row, moved)
+        self.rssi = sparse.csr_array((
+            num.concatenate([old.data[kept], (MAX_STREN - loss[live]).astype(num.float32)]),
+            (num.concatenate([old.row[kept], tag[live]]), num.concatenate([old.col[kept], row[live]]))
+        ), shape=self.rssi.shape)
+        t4 = now()
+
+        self.tick += 1
+        self.timings.append({"move": t1 - t0, "query": t2 - t1, "trace": t3 - t2,
+            "total": t4 - t0, "traced": len(moved)})
+        return self.rssi
@@ -2,32 +2,37 @@ from collections import namedtuple as data
 from attrs import define, field, Factory as default, asdict, astuple
 from ipaddress import IPv6Address
 from random import randint as randInt, random as rand, \
-getrandbits as choose, choice, shuffle, uniform
+getrandbits as choose, getstate, setstate
+from os import path, makedirs
 import numpy as num
 from typing import *
 from numpy.typing import NDArray
-from scipy.stats import qmc
+from scipy import sparse
+from collections.abc import MutableMapping, Mapping
 import matplotlib.pyplot as plot
 from matplotlib.colors import ListedColormap
 from functools import partial
+from .sample import sample as blueNoise, tiled, FILL
 
 """
 Selects positions for nodes (genPoints) and builds a 3D scene representation (init) 
 
-SCENE is a 2D grid of "Chunks," which are 1x1xz slices of the scene. It's built from a 
-Grid[int] kinds and Grid[bool] nodes that inform the properties and content of each chunk.
+SCENE is a columnar Scene of 1x1xz slices ("chunks") of the scene: a kind grid, a height
+grid and a CSR-style index of the controllers in each chunk. It's built from a Grid[int]
+kinds and Grid[bool] nodes that inform the properties and content of each chunk.
 
 The intermediate heights and kinds grids are exported to Blender to build the scene glTF.
 
-Chunks store the UID of any controllers therein. Actual references to a Controller
-instance is stored in dict MESH.
+The index stores the UID of any controllers in a chunk. The controllers themselves are rows
+of the array-backed Fleet MESH (MESH[name] is a Controller view); the links between them
+are in the sparse LINKS matrix.
 
 See main.py for usage
 """
 
 @define
 class Coord:
-    x: int; y: int; z: int
+    x: float; y: float; z: float
 
     def __iter__(self):
         return iter(astuple(self))
@@ -68,18 +73,171 @@ class WiFi:
         }
 
 @define
+class LinkMatrix:
+    """
+    Symmetric sparse store of link strengths between controllers (source of truth for
+    Controller.hears). Links are kept as sorted upper-triangle keys (i << 32 | j, i < j)
+    with their strengths; the symmetric CSR matrix (float32 data, int32 indices) is rebuilt
+    lazily after writes. Writes publish (keys, stren) as one new tuple and the matrix is
+    cached with the tuple it came from, so concurrent readers never see them mismatched
+    """
+    names: List[str] = default(list)
+    _rows: Dict[str, int] = default(dict)
+    _links: Tuple[NDArray, NDArray] = field(factory=lambda: (num.zeros(0, dtype=num.int64),
+        num.zeros(0, dtype=num.float32)))  # (keys, stren), replaced whole
+    _csr: Tuple[Any, int, sparse.csr_array] | None = None  # (links, rows, matrix of them)
+
+    def rows(self, names) -> NDArray:
+        """Matrix rows of names, registering unknown ones"""
+        for name in names:
+            if name not in self._rows:
+                self._rows[name] = len(self.names); self.names.append(name)
+        return num.array([self._rows[name] for name in names], dtype=num.int64)
+
+    def _pack(self, A, B):
+        A, B = num.asarray(A, dtype=num.int64), num.asarray(B, dtype=num.int64)
+        return num.minimum(A, B) << 32 | num.maximum(A, B)
+
+    def set(self, A, B, stren):
+        """Set links between rows A[i] and B[i]"""
+        old, strens = self._links
+        keys = self._pack(A, B)
+        keys, last = num.unique(keys[::-1], return_index=True)  # last write wins
+        stren = num.asarray(stren, dtype=num.float32)[::-1][last]
+        at = num.searchsorted(old, keys)
+        found = at < len(old)
+        found[found] = old[at[found]] == keys[found]
+        strens = strens.copy(); strens[at[found]] = stren[found]
+        self._links = (num.insert(old, at[~found], keys[~found]), num.insert(strens, at[~found], stren[~found]))
+
+    def drop(self, A, B):
+        """Remove links between rows A[i] and B[i] (if any)"""
+        old, strens = self._links
+        keys = self._pack(A, B)
+        at = num.minimum(num.searchsorted(old, keys), max(len(old) - 1, 0))
+        at = at[old[at] == keys] if len(old) else at[:0]
+        self._links = (num.delete(old, at), num.delete(strens, at))
+
+    @property
+    def matrix(self) -> sparse.csr_array:
+        links, n, cached = self._links, len(self.names), self._csr
+        if cached and cached[0] is links and cached[1] == n: return cached[2]
+        keys, stren = links
+        i, j = (keys >> 32).astype(num.int32), (keys & 0xFFFFFFFF).astype(num.int32)
+        mat = sparse.csr_array((num.concatenate([stren, stren]),
+            (num.concatenate([i, j]), num.concatenate([j, i]))), shape=(n, n), dtype=num.float32)
+        self._csr = (links, n, mat)
+        return mat
+
+    def hears(self, name) -> "Hears":
+        return Hears(self, name)
+
+    def save(self, root):
+        keys, stren = self._links
+        num.save(path.join(root, "links.names.npy"), num.array(self.names, dtype=str))
+        num.save(path.join(root, "links.keys.npy"), keys)
+        num.save(path.join(root, "links.stren.npy"), stren)
+
+    def load(self, root):
+        """Replace the links in place with a saved matrix (memory-mapped, copy on write)"""
+        self.names = num.load(path.join(root, "links.names.npy")).tolist()
+        self._rows = {name: i for i, name in enumerate(self.names)}
+        self._links = (num.load(path.join(root, "links.keys.npy"), mmap_mode="c"),
+            num.load(path.join(root, "links.stren.npy"), mmap_mode="c"))
+
+class Hears(MutableMapping):
+    """Controller.hears: one row of a LinkMatrix as a name -> strength mapping (names are
+    only registered in the matrix on write)"""
+    __slots__ = ("_links", "_name")
+
+    def __init__(self, links: LinkMatrix, name: str):
+        self._links, self._name = links, name
+
+    def _entries(self):
+        row = self._links._rows.get(self._name)
+        if row is None: return num.zeros(0, dtype=num.int32), num.zeros(0, dtype=num.float32)
+        mat = self._links.matrix
+        a, b = mat.indptr[row], mat.indptr[row + 1]
+        return mat.indices[a:b], mat.data[a:b]
+
+    def __getitem__(self, name):
+        cols, stren = self._entries()
+        col = self._links._rows.get(name, -1)
+        hit = num.flatnonzero(cols == col)
+        if not len(hit): raise KeyError(name)
+        return float(stren[hit[0]])
+
+    def __setitem__(self, name, stren):
+        row, col = self._links.rows([self._name, name])
+        self._links.set([row], [col], [stren])
+
+    def __delitem__(self, name):
+        if name not in self: raise KeyError(name)
+        self._links.drop([self._links._rows[self._name]], [self._links._rows[name]])
+
+    def clear(self):
+        cols, _ = self._entries()
+        if len(cols): self._links.drop(num.full(len(cols), self._links._rows[self._name]), cols)
+
+    def __iter__(self):
+        cols, _ = self._entries()
+        return iter([self._links.names[c] for c in cols])
+
+    def __len__(self):
+        return len(self._entries()[0])
+
+    def toJson(self):
+        cols, stren = self._entries()
+        return dict(zip([self._links.names[c] for c in cols], stren.tolist()))
+
 class Controller:
-    name: str
-    comm: BLE|Radio|WiFi
-    pos: Coord
-    orient: Rot
-    ip: str = field()
-    hears: Dict[str, float] = default(dict)
-
-    @ip.default # type: ignore
-    def genIPv6(self) -> str:
-        return str(IPv6Address(choose(128))).upper()
-    
+    """
+    One row of a Fleet: reads and whole-field writes (c.pos = Coord(...)) go straight to
+    the fleet's arrays; the Coord/Rot/comm instances it returns are fresh copies
+    """
+    __slots__ = ("_fleet", "_row")
+
+    def __init__(self, fleet: "Fleet", row: int):
+        self._fleet, self._row = fleet, row
+
+    @property
+    def name(self) -> str:
+        return self._fleet.names[self._row]
+
+    @property
+    def comm(self) -> BLE|Radio|WiFi:
+        return COMMS[self._fleet.comm[self._row]]()
+
+    @property
+    def pos(self) -> Coord:
+        return Coord(*self._fleet.pos[self._row].tolist())
+
+    @pos.setter
+    def pos(self, pos):
+        self._fleet.pos[self._row] = tuple(pos)
+
+    @property
+    def orient(self) -> Rot:
+        return Rot(*self._fleet.orient[self._row].tolist())
+
+    @orient.setter
+    def orient(self, rot):
+        self._fleet.orient[self._row] = num.round(astuple(rot) if isinstance(rot, Rot) else rot, 3)
+
+    @property
+    def ip(self) -> str:
+        return _ipv6(*self._fleet.ip[self._row])
+
+    @property
+    def hears(self) -> Hears:
+        return LINKS.hears(self.name)
+
+    def __eq__(self, other):
+        return isinstance(other, Controller) and (self._fleet, self._row) == (other._fleet, other._row)
+
+    def __repr__(self):
+        return f"Controller({self.name!r}, {self.comm!r}, {self.pos!r}, {self.orient!r})"
+
     def toJson(self):
         return {
             "name": self.name,
@@ -87,9 +245,106 @@ class Controller:
             "pos": asdict(self.pos),
             "orient": asdict(self.orient),
             "ip": self.ip,
-            "hears": self.hears
+            "hears": self.hears.toJson()
         }
 
+COMMS = (BLE, Radio, WiFi)  # comm type codes
+
+def _ipv6(hi, lo) -> str:
+    return str(IPv6Address(int(hi) << 64 | int(lo))).upper()
+
+def _ipv6s(ip) -> List[str]:
+    """_ipv6 of every (hi, lo) row; only rows with a zero run to compress go through IPv6Address"""
+    hextets = (ip[:, :, None] >> num.array([48, 32, 16, 0], dtype=num.uint64)).reshape(-1, 8) & 0xFFFF
+    fmt = ":".join(["%X"]*8)
+    out = [fmt % tuple(row) for row in hextets.tolist()]
+    for i in num.flatnonzero(((hextets[:, :-1] == 0) & (hextets[:, 1:] == 0)).any(axis=1)):
+        out[i] = _ipv6(*ip[i])
+    return out
+
+@define(eq=False)
+class Fleet(Mapping):
+    """
+    Every controller as one row of contiguous arrays: pos (x, y, z), orient (p, y, r),
+    comm (code into COMMS) and ip (two uint64 halves of the 128-bit address). Maps
+    name -> Controller view like the old dict, so per-node code keeps working, while bulk
+    work (Index.of, move, toJson) runs on the arrays
+    """
+    names: List[str] = default(list)
+    pos: NDArray = field(factory=lambda: num.zeros((0, 3), dtype=float))
+    orient: NDArray = field(factory=lambda: num.zeros((0, 3), dtype=float))
+    comm: NDArray = field(factory=lambda: num.zeros(0, dtype=num.uint8))
+    ip: NDArray = field(factory=lambda: num.zeros((0, 2), dtype=num.uint64))
+    _rows: Dict[str, int] = default(dict)
+
+    def __getitem__(self, name) -> Controller:
+        return Controller(self, self._rows[name])
+
+    def __iter__(self):
+        return iter(self.names)
+
+    def __len__(self):
+        return len(self.names)
+
+    def __contains__(self, name):
+        return name in self._rows
+
+    def rows(self, names) -> NDArray:
+        return num.array([self._rows[name] for name in names], dtype=num.int64)
+
+    def add(self, names, comm, pos, orient):
+        """
+        Append controllers; comm is a type name (e.g. "BLE") or per-node codes. The ips are
+        drawn in one getrandbits call, the same bits as one getrandbits(128) per node
+        """
+        n = len(names)
+        if isinstance(comm, str): comm = [COMMS.index(globals()[comm])]*n
+        ip = num.frombuffer(choose(128*n).to_bytes(16*n, "little"), dtype="<u8").reshape(-1, 2)[:, ::-1] if n else []
+        self._rows.update((name, len(self.names) + i) for i, name in enumerate(names))
+        self.names += list(names)
+        self.pos = num.concatenate([self.pos, num.asarray(pos, dtype=float).reshape(-1, 3)])
+        self.orient = num.concatenate([self.orient, num.round(num.reshape(orient, (-1, 3)), 3)])
+        self.comm = num.concatenate([self.comm, num.asarray(comm, dtype=num.uint8)])
+        self.ip = num.concatenate([self.ip, num.asarray(ip, dtype=num.uint64).reshape(-1, 2)])
+
+    FIELDS = ("pos", "orient", "comm", "ip")
+
+    def save(self, root):
+        num.save(path.join(root, "fleet.names.npy"), num.array(self.names, dtype=str))
+        for name in self.FIELDS: num.save(path.join(root, f"fleet.{name}.npy"), getattr(self, name))
+
+    def load(self, root):
+        """Replace the fleet in place with a saved one (memory-mapped, copy on write)"""
+        self.names = num.load(path.join(root, "fleet.names.npy")).tolist()
+        self._rows = {name: i for i, name in enumerate(self.names)}
+        for name in self.FIELDS:
+            setattr(self, name, num.load(path.join(root, f"fleet.{name}.npy"), mmap_mode="c"))
+
+    def move(self, moves: Dict[str, Any]):
+        """Set the positions of {name: (x, y, z)} in one write (kept as given, like Links.pos)"""
+        self.pos[self.rows(moves)] = num.asarray(list(moves.values()), dtype=float).reshape(-1, 3)
+
+    def toJson(self):
+        """Controller.toJson of every row, with links read from one pass over LINKS"""
+        mat = LINKS.matrix  # before rows(): registering names would invalidate it
+        at = LINKS.rows(self.names)
+        at = num.where(at < mat.shape[0], at, -1).tolist()
+        ptr, cols, stren = mat.indptr.tolist(), mat.indices.tolist(), mat.data.tolist()
+        comms = [c().toJson() for c in COMMS]
+        out = []
+        for i, (x, y, z), (p, yaw, r), code, ip in zip(range(len(self)), self.pos.tolist(),
+            self.orient.tolist(), self.comm.tolist(), _ipv6s(self.ip)):
+            a, b = (ptr[at[i]], ptr[at[i] + 1]) if at[i] >= 0 else (0, 0)
+            out.append({
+                "name": self.names[i],
+                "comm": dict(comms[code]),
+                "pos": {"x": x, "y": y, "z": z},
+                "orient": {"p": p, "y": yaw, "r": r},
+                "ip": ip,
+                "hears": dict(zip([LINKS.names[c] for c in cols[a:b]], stren[a:b]))
+            })
+        return out
+
 KINDS = {
     0: "empty",
     1: "shelf",
@@ -99,96 +354,298 @@ KINDS = {
 COL = \
 [ "white", "peru", "sienna", "dimgray" ]
 
-@define
-class Chunk:
-    kind: str
-    height: int
-    nodes: List[str] = default(list)
-
 type Grid[T] = NDArray[(int, int), T] # type: ignore
 type Volume[T] = NDArray[(int, int, int), T] # type: ignore
 
+@define
+class Scene:
+    """
+    Kind (uint8) and height (int16) of every chunk, plus the controllers in each one:
+    names[ptr[c]:ptr[c+1]] for the flat (row-major) chunk index c
+    """
+    kinds: Grid[num.uint8]
+    heights: Grid[num.int16]
+    ptr: NDArray = field()
+    names: List[str] = default(list)
+    ceil: int = field(factory=lambda: H)  # scene height
+
+    @ptr.default # type: ignore
+    def _empty(self):
+        return num.zeros(self.kinds.size + 1, dtype=num.int32)
+
+    @property
+    def shape(self):
+        return self.kinds.shape
+
+    def kind(self, x, y) -> str:
+        return KINDS[int(self.kinds[x, y])]
+
+    def height(self, x, y) -> int:
+        return int(self.heights[x, y])
+
+    def nodes(self, x, y) -> List[str]:
+        c = x*self.shape[1] + y
+        return self.names[self.ptr[c]:self.ptr[c + 1]]
+
+    def occupied(self) -> Grid[bool]:
+        return (num.diff(self.ptr) > 0).reshape(self.shape)
+
+    def place(self, cells, names):
+        """Index controllers names by their (x, y) cells"""
+        flat = num.ravel_multi_index(tuple(num.asarray(cells, dtype=int).reshape(-1, 2).T), self.shape)
+        self.names = [names[i] for i in num.argsort(flat, kind="stable")]
+        counts = num.bincount(flat, minlength=self.kinds.size)
+        self.ptr = num.concatenate([[0], num.cumsum(counts)]).astype(num.int32)
 
-def _makeHeights(kind: int) -> int:
-    return {
-        "empty": 0,
-        "shelf": H // 2,
-        "pile": randInt(1, H // 4),
-        "wall": H
-    }[KINDS[kind]]
 
+@define
+class Runs:
+    """
+    Run-length columns: column c = x*Y + y holds runs ptr[c]:ptr[c+1], bottom to top, each
+    of kinds[r] from z0[r] up to (not including) z1[r]; the rest of the column is air.
+    Memory follows the number of runs (surfaces), not the scene height
+    """
+    shape: Tuple[int, int, int]
+    ptr: NDArray  # int64, X*Y + 1
+    z0: NDArray; z1: NDArray  # int16
+    kinds: NDArray  # uint8
+
+    @classmethod
+    def of(cls, cloud: Volume) -> "Runs":
+        """Encode a dense kind volume (in row blocks, so memmaps stream)"""
+        X, Y, Z = cloud.shape
+        counts, z0s, z1s, kinds = [], [], [], []
+        step = max(1, ROWS // (Y*Z))
+        for i in range(0, X, step):
+            block = num.asarray(cloud[i:i+step]).reshape(-1, Z)
+            pad = num.zeros((len(block), 1), dtype=block.dtype)
+            starts = (block != 0) & (block != num.hstack([pad, block[:, :-1]]))
+            ends = (block != 0) & (block != num.hstack([block[:, 1:], pad]))
+            col, z0 = num.nonzero(starts)  # row-major: by column, then z
+            z0s.append(z0); z1s.append(num.nonzero(ends)[1] + 1)
+            kinds.append(block[col, z0]); counts.append(num.bincount(col, minlength=len(block)))
+        ptr = num.concatenate([[0], num.cumsum(num.concatenate(counts))])
+        return cls((X, Y, Z), ptr.astype(num.int64), num.concatenate(z0s).astype(num.int16),
+            num.concatenate(z1s).astype(num.int16), num.concatenate(kinds).astype(num.uint8))
+
+    @classmethod
+    def columns(cls, kinds: Grid, heights: Grid, ceil: int) -> "Runs":
+        """One run per column, kinds from the floor up to heights (what _makeCloud fills)"""
+        solid = ((kinds != 0) & (heights > 0)).ravel()
+        ptr = num.concatenate([[0], num.cumsum(solid)])
+        n = int(solid.sum())
+        return cls((*kinds.shape, ceil), ptr.astype(num.int64), num.zeros(n, dtype=num.int16),
+            heights.ravel()[solid].astype(num.int16), kinds.ravel()[solid].astype(num.uint8))
+
+    def cols(self) -> NDArray:
+        """Column of every run"""
+        return num.repeat(num.arange(len(self.ptr) - 1), num.diff(self.ptr))
+
+    def top(self, cols=None) -> Tuple[NDArray, NDArray]:
+        """Height and kind of each column's highest run (0, 0 if empty): grids, or of cols only"""
+        X, Y, _ = self.shape
+        c = num.arange(X*Y) if cols is None else num.asarray(cols)
+        last = self.ptr[c + 1] - 1; solid = self.ptr[c + 1] > self.ptr[c]
+        heights, kinds = num.zeros(len(c), dtype=num.int16), num.zeros(len(c), dtype=num.uint8)
+        heights[solid], kinds[solid] = self.z1[last[solid]], self.kinds[last[solid]]
+        if cols is None: return heights.reshape(X, Y), kinds.reshape(X, Y)
+        return heights, kinds
+
+    def patch(self, cloud: Volume, cols) -> "Runs":
+        """These runs with columns cols (flat x*Y + y) re-encoded from cloud, the rest kept"""
+        X, Y, Z = self.shape
+        cols = num.unique(cols)
+        fresh = Runs.of(num.asarray(cloud).reshape(X*Y, Z)[cols][:, None])
+        owner = self.cols(); keep = ~num.isin(owner, cols)
+        owner = num.concatenate([owner[keep], num.repeat(cols, num.diff(fresh.ptr))])
+        order = num.argsort(owner, kind="stable")  # kept runs and fresh ones are each in order
+        ptr = num.concatenate([[0], num.cumsum(num.bincount(owner, minlength=X*Y))])
+        pick = lambda old, new: num.concatenate([old[keep], new])[order]
+        return Runs(self.shape, ptr.astype(num.int64), pick(self.z0, fresh.z0), pick(self.z1, fresh.z1),
+            pick(self.kinds, fresh.kinds))
+
+    def dense(self, out: Volume) -> Volume:
+        """Decode into out (X, Y, Z), in row blocks"""
+        X, Y, Z = self.shape
+        step = max(1, ROWS // (Y*Z)); cols = self.cols()
+        for i in range(0, X, step):
+            a, b = self.ptr[i*Y], self.ptr[min(i + step, X)*Y]
+            rows = min(i + step, X) - i
+            col = cols[a:b] - i*Y
+            edges = num.zeros((rows*Y, Z + 1), dtype=num.int16)  # +kind at z0, -kind at z1
+            kind = self.kinds[a:b].astype(num.int16)
+            num.add.at(edges, (col, self.z0[a:b]), kind)
+            num.add.at(edges, (col, self.z1[a:b]), -kind)
+            out[i:i+step] = num.cumsum(edges[:, :Z], axis=1).reshape(rows, Y, Z)
+        return out
+
+    def sides(self, cols, dx, dy) -> Tuple[NDArray, NDArray, NDArray]:
+        """
+        Exposed parts (run, lo, hi) of every run's side facing (dx, dy): the run's z-range
+        cut at the neighbour column's run ends, keeping the pieces no neighbour run covers
+        (cols: self.cols(); outside the scene covers nothing)
+        """
+        X, Y, Z = self.shape
+        x, y = cols // Y + dx, cols % Y + dy
+        inside = (x >= 0) & (x < X) & (y >= 0) & (y < Y)
+        near = num.where(inside, x*Y + y, 0)
+        first = self.ptr[near]; count = num.where(inside, self.ptr[near + 1] - first, 0)
+
+        # breakpoints: own ends, plus the neighbour's run ends clipped into the run
+        own = num.repeat(num.arange(len(cols)), count)
+        other = num.repeat(first - num.cumsum(count) + count, count) + num.arange(count.sum())
+        z0, z1 = self.z0.astype(int), self.z1.astype(int)
+        run = num.concatenate([num.arange(len(cols)), num.arange(len(cols)), own, own])
+        z = num.concatenate([z0, z1, num.clip(z0[other], z0[own], z1[own]), num.clip(z1[other], z0[own], z1[own])])
+        order = num.lexsort((z, run)); run, z = run[order], z[order]
+        piece = (run[:-1] == run[1:]) & (z[:-1] < z[1:])
+        run, lo, hi = run[:-1][piece], z[:-1][piece], z[1:][piece]
+
+        # a piece is covered if the neighbour run starting at or below its middle reaches past it
+        span = 2*Z + 2; mid = lo + hi  # doubled: stays integer
+        keys = cols*span + 2*z0
+        j = num.maximum(num.searchsorted(keys, near[run]*span + mid, side="right") - 1, 0)
+        covered = inside[run] & (cols[j] == near[run]) & (2*z0[j] <= mid) & (mid < 2*z1[j])
+        return run[~covered], lo[~covered], hi[~covered]
+
+    def tops(self, cols) -> NDArray:
+        """Runs with no run stacked right on top (cols: self.cols())"""
+        same = num.append(cols[1:] == cols[:-1], False)
+        return num.flatnonzero(~(same & (num.append(self.z0[1:], -1) == self.z1)))
+
+    FIELDS = ("ptr", "z0", "z1", "kinds")
+
+    def save(self, root):
+        num.save(path.join(root, "runs.shape.npy"), num.array(self.shape))
+        for name in self.FIELDS: num.save(path.join(root, f"runs.{name}.npy"), getattr(self, name))
+
+    @classmethod
+    def load(cls, root) -> "Runs":
+        """A saved Runs (memory-mapped, read only)"""
+        shape = tuple(num.load(path.join(root, "runs.shape.npy")).tolist())
+        return cls(shape, *(num.load(path.join(root, f"runs.{name}.npy"), mmap_mode="r")
+            for name in cls.FIELDS))
+
+def _randInts(n, a, b) -> NDArray:
+    """
+    The next n values of randInt(a, b), drawn in bulk. randInt(a, b) is a + r for the first
+    r = getrandbits(k) below span = b - a + 1, k = span.bit_length(); up to 32 bits, each try
+    is the top k bits of one 32-bit Mersenne Twister word, so the words are pulled with one
+    getrandbits call and the generator is left exactly where n calls leave it
+    """
+    span = b - a + 1; k = span.bit_length()
+    if k > 32: return num.array([randInt(a, b) for _ in range(n)], dtype=int)  # several words a try
+    state = getstate(); m = n * (1 << k) // span + 64  # expected tries, plus slack
+    while True:  # find how many words n accepted draws take
+        words = num.frombuffer(choose(32*m).to_bytes(4*m, "little"), dtype="<u4")  # first word lowest
+        ok = num.flatnonzero(words >> (32 - k) < span)
+        if len(ok) >= n: break
+        setstate(state); m *= 2
+    setstate(state)
+    if n: choose(32*(ok[n-1] + 1))  # consume exactly those words
+    return a + (words[ok[:n]] >> (32 - k)).astype(int)
+
+def _makeHeights(kinds: Grid, probe=True) -> Grid:
+    fixed = {"empty": 0, "shelf": H // 2, "pile": 0, "wall": H}
+    heights = num.array([fixed[KINDS[k]] for k in sorted(KINDS)])[kinds]
+
+    # same draws as num.vectorize over the per-cell dict: one per cell, plus one for the
+    # vectorize probe of the first cell, so seeded scenes stay reproducible (probe: first block)
+    draws = _randInts(kinds.size + probe, 1, H // 4)[probe:].reshape(kinds.shape)
+    piles = kinds == 2
+    heights[piles] = draws[piles]
+    return heights
 
 def _makeCloud(kinds: Grid, heights: Grid ) -> Volume:
-    cloud = num.zeros((*kinds.shape, H), dtype=int)
-
-    for pos in num.ndindex(kinds.shape):
-        kind = kinds[pos]
-        height = heights[pos]
-        
-        # fill w/ kind up to height:
-        cloud[*pos, :height] = kind
-
-    return cloud
-
-def _makeChunk(kind: int, height: int) -> Chunk:
-    return Chunk(KINDS[kind], height)
-
-def _makeNodes(chunk: Chunk, x, y, node: bool):
-    free = None; z = 0
-    if node:
-        match chunk.kind:
-            case "empty": 
-                z = choice([0, H])
-                free = "ciel" if z == H else "floor"
-            case "shelf" | "pile" | "wall": 
-                # (0, 0) is top left (2D rep)
-                dirs = [(0, 1), (0, -1), (1, 0), (-1, 0), "top"]
-                shuffle(dirs)
-                for d in dirs:
-                    if d == "top":
-                        if chunk.height < H:
-                            z = chunk.height; free = d
-                        break
-                    pos = tuple(num.add(d, (x,y))) 
-                    W, D = _chunks.shape # bounds check (inverted):
-                    if not (0 <= pos[0] < W and 0 <= pos[1] < D): continue
-                    if chunk.height > _chunks[pos].height: #type: ignore
-                        z = randInt(_chunks[pos].height+1, chunk.height) #type: ignore
-                        free = d; break
-            case _: raise ValueError(f"Invalid feature: {chunk.kind}")
-    if free: 
-        pitch, yaw, roll = 0, 0, rand()*360
-        match free:
-            case "ciel": pitch, yaw = uniform(60, -240), uniform(60, -240)
-            case "floor": pitch, yaw = uniform(-60, 240), uniform(-60, 240)
-            case "top": pitch, yaw = uniform(0, 180), uniform(0, 180) 
-            case (1, 0): yaw = uniform(-90, 90) # E
-            case (0,-1): yaw = uniform(0, 180) # N
-            case (-1,0): yaw = uniform(90, 270) # W
-            case (0, 1): yaw = uniform(180, 360) # S
-            case _: raise ValueError(f"Invalid location: {free}")
-        if type(free) is tuple: pitch = uniform(90, 180)
-
-        name = f"C{_makeNodes.nth:0{len(str(_maxN))}d}"
-        MESH[name] = Controller(
-            name, globals()[TYPE](), Coord(x, y, z), Rot(pitch, yaw, roll),
-        ) # type: ignore
-        _makeNodes.nth += 1
-        chunk.nodes.append(name)
-
-    return chunk
+    # fill w/ kind up to height:
+    below = num.arange(H, dtype=heights.dtype) < heights[..., None]
+    return num.where(below, kinds[..., None].astype(num.uint8), num.uint8(0))
+
+# free faces: the four sides as (dx, dy) offsets, then top, ceiling and floor
+SIDES = num.array([(0, 1), (0, -1), (1, 0), (-1, 0)])
+TOP, CIEL, FLOOR = 4, 5, 6
+# per face: uniform(a, b) bounds of pitch, then yaw (sides: yaw faces away from the wall)
+ANGLES = num.array([
+    (90, 180, 180, 360),  # (0, 1) S
+    (90, 180, 0, 180),    # (0,-1) N
+    (90, 180, -90, 90),   # (1, 0) E
+    (90, 180, 90, 270),   # (-1,0) W
+    (0, 180, 0, 180),     # top
+    (60, -240, 60, -240), # ciel
+    (-60, 240, -60, 240), # floor
+], dtype=float)
+
+def _faces(cells) -> Tuple[NDArray, NDArray]:
+    """
+    Free face of each (x, y) chunk and the z of a controller on it, read from the runs: an
+    empty column gets the floor or ceiling; any other a face picked uniformly among the tops
+    of its runs and the exposed pieces of their sides (those facing into the scene), at a
+    uniform height over the piece (face -1: the top of a full-height run, no room)
+    """
+    x, y = num.reshape(cells, (-1, 2)).T
+    (X, Y, ceil), n = runs.shape, len(x)
+    cols = runs.cols()
+    options = [(num.full(1, 0), num.full(1, X*Y), num.zeros(1, int), num.zeros(1, int))]  # sentinel
+    for face, (dx, dy) in enumerate(SIDES.tolist()):
+        run, lo, hi = runs.sides(cols, dx, dy)
+        nx, ny = cols[run] // Y + dx, cols[run] % Y + dy
+        inside = (nx >= 0) & (nx < X) & (ny >= 0) & (ny < Y)
+        options.append((num.full(inside.sum(), face), cols[run][inside], lo[inside] + 1, hi[inside]))
+    top = runs.tops(cols); z1 = runs.z1[top].astype(int)
+    options.append((num.full(len(top), TOP), cols[top], z1, z1))
+    face, owner, lo, hi = (num.concatenate(o) for o in zip(*options))
+    order = num.argsort(owner, kind="stable")
+    face, owner, lo, hi = face[order], owner[order], lo[order], hi[order]
+
+    # uniform pick among the column's options (none: an empty column, floor or ceiling)
+    col = x*Y + y
+    first = num.searchsorted(owner, col); count = num.searchsorted(owner, col, side="right") - first
+    pick = first + (num.random.random(n) * count).astype(int)
+    ciel = num.random.random(n) < 0.5
+    empty = count == 0
+    z = num.random.randint(lo[pick], hi[pick] + 1)
+    face = num.where(empty, num.where(ciel, CIEL, FLOOR), face[pick])
+    z = num.where(empty, num.where(ciel, ceil, 0), z)
+    face[(face == TOP) & (z >= ceil)] = -1
+    return face, z
+
+def _makeNodes(nodes: Grid[bool]):
+    """
+    Places a controller in every flagged chunk at once, on a free face (see _faces) and
+    turned away from it: faces, z, angles and ips are drawn in bulk
+    """
+    cells = num.argwhere(nodes)  # row-major
+    face, z = _faces(cells)
+    keep = num.flatnonzero(face >= 0)
+    cells, face, z = cells[keep], face[keep], z[keep]
+    n = len(keep)
+
+    pa, pb, ya, yb = ANGLES[face].T
+    pitch, yaw = pa + (pb - pa)*num.random.random(n), ya + (yb - ya)*num.random.random(n)
+    roll = num.random.random(n)*360
+
+    names = [f"C{_makeNodes.nth + i:0{len(str(_maxN))}d}" for i in range(n)]
+    _makeNodes.nth += n
+    MESH.add(names, TYPE, num.column_stack([cells, z]), num.column_stack([pitch, yaw, roll]))
+    return cells, names
 _makeNodes.nth = 0
 _maxN = 0
 
-def genPoints(x, y, r=5, n=None) -> Grid:
-    sample = qmc.PoissonDisk(d=2, radius=r / min(x, y)).fill_space()
-    sample[:, 0], sample[:, 1] = sample[:, 0] * x, sample[:, 1] * y # scale: fit
-    N = len(sample)
-    if not n: n = N // 4
+def genPoints(x, y, r=5, n=None, tiles=False) -> Grid:
+    """
+    Scatters n nodes no closer than r (default: a quarter of a full fill) over the floor.
+    tiles=True picks them from a fill built of cached blue-noise tiles (see sample.py)
+    """
+    if tiles:
+        sample = tiled(x, y, r); N = len(sample)
+        if not n: n = N // 4
+        # Select points to reduce uniformity:
+        sample = sample[num.random.choice(N, min(n, N), replace=False)]
+    else:
+        if not n: n = int(FILL * x*y / r**2) // 4
+        sample = blueNoise(x, y, r, n)
     global _maxN; _maxN = n
-    # Select points to reduce uniformity:
-    indices = num.random.choice(N, min(n, N), replace=False)
-    points = sample[indices].astype(int)
+    points = sample.astype(int)
 
     array: Grid = num.zeros((y, x), dtype=bool)
     # Represent points as bool:
@@ -198,7 +655,7 @@ def genPoints(x, y, r=5, n=None) -> Grid:
 
 def _showFig(kinds):
     # Get updated nodes from SCENE
-    new_nodes = num.argwhere(num.vectorize(lambda x: bool(x.nodes))(SCENE))
+    new_nodes = num.argwhere(SCENE.occupied())
 
     _, ax = plot.subplots(figsize=(8, 8))
     ax.imshow(kinds, cmap=ListedColormap(COL), origin="lower")
@@ -213,17 +670,107 @@ def _showFig(kinds):
 
 H = 20
 TYPE: str = ""
-MESH: Dict[str, Controller] = {}
-SCENE: Grid[Chunk]; _chunks: Grid[Chunk]; heights: Grid[int]; cloud: Volume[int]
-
-def init(kinds: Grid[int], nodes: Grid[bool], show=False):
-    global SCENE, _chunks, heights, cloud
+MESH = Fleet()  # every controller (MESH[name] is a Controller view)
+LINKS = LinkMatrix()  # link strengths of MESH (Controller.hears views into it)
+SCENE: Scene; heights: Grid[int]; cloud: Volume[int] | None
+runs: Runs  # run-length form of cloud (built without it when dense=False)
+atten: Volume[float] | None = None  # loss per metre of each voxel
+loss: NDArray | None = None  # per-kind table atten was built from
+
+ROWS = 1 << 26  # voxels generated, or read from a (possibly memory-mapped) volume, at a time
+
+def _array(root, name, shape, dtype) -> NDArray:
+    """In-memory array, or a .npy-backed memmap under root"""
+    if root is None: return num.zeros(shape, dtype=dtype)
+    return num.lib.format.open_memmap(path.join(root, f"{name}.npy"), "w+", dtype, shape)
+
+def _atten(table, out, dense) -> Volume[float] | None:
+    global loss
+    loss = None if table is None or out or not dense else num.asarray(table, dtype=num.float32)
+    return None if loss is None else loss[cloud]
+
+def init(kinds: Grid[int], nodes: Grid[bool], show=False, table=None, out=None, levels=None,
+    dense=True):
+    """
+    table: per-kind loss per metre (e.g. signal.ATTEN); if given, also builds atten.
+    out: directory for out-of-core scenes: kinds, heights and cloud become memmaps there,
+    generated in row blocks (atten is then skipped: trace the kind cloud instead).
+    levels: a Runs scene (e.g. multi-level) instead of generating one from kinds; SCENE is
+    then its top view. dense=False skips cloud and atten: rep.runs is the only volume
+    """
+    global SCENE, heights, cloud, atten, runs
     # 2D primitives stored to file and passed to Blender (obj.py)
-    heights = num.vectorize(_makeHeights)(kinds)
-    _chunks = num.vectorize(_makeChunk)(kinds, heights)
-    cloud = _makeCloud(kinds, heights)
-
-    Xs, Ys = num.indices(_chunks.shape) # extract indices
-    SCENE = num.vectorize(_makeNodes)(_chunks, Xs, Ys, nodes)
+    X, Y = kinds.shape
+    if out: makedirs(out, exist_ok=True)
+    Z = H if levels is None else levels.shape[2]
+    SCENE = Scene(_array(out, "kinds", (X, Y), num.uint8), _array(out, "heights", (X, Y), num.int16),
+        ceil=Z)
+    heights = SCENE.heights
+    cloud = _array(out, "cloud", (X, Y, Z), num.uint8) if dense else None
+    if levels is None:
+        step = max(1, ROWS // (Y*H))
+        for i in range(0, X, step):
+            block = slice(i, i + step)
+            SCENE.kinds[block] = kinds[block]
+            heights[block] = _makeHeights(kinds[block], probe=i == 0)
+            if dense: cloud[block] = _makeCloud(kinds[block], heights[block])
+        runs = Runs.columns(SCENE.kinds, heights, H)
+    else:
+        runs = levels
+        heights[:], SCENE.kinds[:] = runs.top()
+        if dense: runs.dense(cloud)
+    if out: SCENE.kinds.flush(); heights.flush()
+    if out and dense: cloud.flush()
+    atten = _atten(table, out, dense)
+
+    SCENE.place(*_makeNodes(nodes))
 
     if show: _showFig(kinds)
+
+def save(root):
+    """Store what init generated (kinds, heights, runs, MESH) under root"""
+    num.save(path.join(root, "kinds.npy"), SCENE.kinds)
+    num.save(path.join(root, "heights.npy"), SCENE.heights)
+    runs.save(root)  # the columns, or the levels init was given
+    MESH.save(root)
+
+def load(root, table=None, out=None, dense=True):
+    """
+    init from a save(root) instead of generating: the grids, runs and fleet are memory-mapped
+    and cloud (if dense) is decoded from the saved runs, so levels scenes keep their levels
+    """
+    global SCENE, heights, cloud, atten, runs
+    runs = Runs.load(root)
+    X, Y, Z = runs.shape
+    SCENE = Scene(num.load(path.join(root, "kinds.npy"), mmap_mode="r"),
+        num.load(path.join(root, "heights.npy"), mmap_mode="r"), ceil=Z)
+    heights = SCENE.heights
+    if out: makedirs(out, exist_ok=True)
+    cloud = runs.dense(_array(out, "cloud", (X, Y, Z), num.uint8)) if dense else None
+    if out and dense: cloud.flush()
+    atten = _atten(table, out, dense)
+
+    MESH.load(root); _makeNodes.nth = len(MESH)
+    SCENE.place(MESH.pos[:, :2], MESH.names)
+
+def edit(voxels):
+    """
+    Set voxels [(x, y, z, kind), ...] of a dense scene; atten, and the runs and SCENE's top
+    view of the edited columns, follow (re-trace links with sim.links.Links.edit). Re-mesh
+    with gen.build.build(cloud, ...): only the strips holding edited voxels are marched again
+    """
+    global heights, runs
+    voxels = num.asarray(voxels, dtype=int).reshape(-1, 4)
+    at, kind = voxels[:, :3], voxels[:, 3]
+    if cloud is None: raise ValueError("scene has no cloud (init with dense=True)")
+    if ((at < 0) | (at >= cloud.shape)).any(): raise IndexError("voxel outside the scene")
+    if not num.isin(kind, list(KINDS)).all(): raise ValueError("unknown kind")
+    if not len(voxels): return
+    cloud[tuple(at.T)] = kind
+    if atten is not None: atten[tuple(at.T)] = loss[kind]
+    cols = num.unique(at[:, 0]*cloud.shape[1] + at[:, 1])
+    runs = runs.patch(cloud, cols)
+    if not SCENE.heights.flags.writeable:  # loaded (read-only map): copied on the first edit
+        SCENE.heights, SCENE.kinds = num.array(SCENE.heights), num.array(SCENE.kinds)
+    heights = SCENE.heights
+    heights.flat[cols], SCENE.kinds.flat[cols] = runs.top(cols)
@@ -0,0 +1,114 @@
+import numpy as num
+from typing import *
+from numpy.typing import NDArray
+from math import inf, sqrt
+from os import path, makedirs, replace
+from scipy.spatial import cKDTree as KDTree
+
+"""
+Blue-noise (Poisson disk) point sampling for node placement (rep.genPoints)
+
+sample() is a grid-accelerated, batched Bridson sampler: dart-throwing rounds spread the
+first points over the whole floor, then every point still active throws K candidates in
+its r..2r annulus per round. Candidates are checked against a background grid (cell r/√2,
+so at most one point per cell) and against each other, and sampling stops at n points.
+
+tile() is a periodic (wrap-around) fill of a square; copies of it laid side by side stay
+blue noise across the seams, so tiled() covers arbitrarily large floors. Tiles are cached
+under TILES keyed by radius and size.
+
+points = sample(60, 80, r=5, n=40); points = tiled(4000, 4000, r=5)
+"""
+
+K = 30  # candidates per active point per round
+BATCH = 1 << 14  # candidates per dart-throwing round
+TILE = 64  # tile side, in radii
+TILES = path.join(".cache", "tiles")
+FILL = 0.62  # points per r^2 of floor in a full fill
+
+# grid offsets to check, nearest first: most rejected candidates are caught early
+NEAR = sorted(((di, dj) for di in range(-2, 3) for dj in range(-2, 3)), key=lambda d: d[0]**2 + d[1]**2)
+
+def _fits(cand, pts, grid, cell, r, size, wrap):
+    """Candidates no closer than r to any gridded point"""
+    ij = num.minimum((cand // cell).astype(int), num.array(grid.shape) - 1)
+    left = num.arange(len(cand))  # still fitting
+    for di, dj in NEAR:
+        i, j = ij[left, 0] + di, ij[left, 1] + dj
+        if wrap: i, j = i % grid.shape[0], j % grid.shape[1]
+        inside = (i >= 0) & (i < grid.shape[0]) & (j >= 0) & (j < grid.shape[1])
+        near = num.full(len(left), -1)
+        near[inside] = grid[i[inside], j[inside]]
+        has = num.flatnonzero(near >= 0)
+        d = num.abs(cand[left[has]] - pts[near[has]])
+        if wrap: d = num.minimum(d, size - d)
+        left = num.delete(left, has[(d**2).sum(axis=1) < r*r])
+    ok = num.zeros(len(cand), dtype=bool); ok[left] = True
+    return ok
+
+def _thin(cand, r, size, wrap):
+    """Drop candidates within r of an earlier candidate (keeps the first of each pair)"""
+    if wrap: cand = cand % size
+    tree = KDTree(cand, boxsize=size if wrap else None)
+    pairs = tree.query_pairs(r, output_type="ndarray")
+    ok = num.ones(len(cand), dtype=bool)
+    ok[pairs.max(axis=1)] = False  # conservative: a later point loses even if its rival does
+    return ok
+
+def sample(w, h, r, n=inf, wrap=False, darts=0.1) -> NDArray:
+    """
+    Up to n points in [0, w) x [0, h), no two closer than r (toroidally if wrap). Dart
+    throwing runs until fewer than a fraction darts of a round is accepted, then Bridson
+    rounds fill the gaps until n points or no active points are left
+    """
+    size = num.array([w, h], dtype=float)
+    dims = num.maximum(num.ceil(size / (r / sqrt(2))).astype(int), 1)
+    cell = size / dims  # <= r/√2 and divides the area exactly (needed for wrap)
+    grid = num.full(dims, -1, dtype=num.int64)
+    pts = num.zeros((0, 2)); active = num.zeros(0, dtype=int)
+
+    def add(cand):
+        nonlocal pts, active
+        ok = _fits(cand, pts, grid, cell, r, size, wrap)
+        cand = cand[ok]
+        cand = cand[_thin(cand, r, size, wrap)][:max(int(min(n, 1 << 62)) - len(pts), 0)]
+        ij = num.minimum((cand // cell).astype(int), dims - 1)  # float edge: x % w == w
+        grid[ij[:, 0], ij[:, 1]] = num.arange(len(pts), len(pts) + len(cand))
+        active = num.concatenate([active, num.arange(len(pts), len(pts) + len(cand))])
+        pts = num.concatenate([pts, cand])
+        return len(cand)
+
+    while len(pts) < n:  # darts: uniform over the whole floor
+        batch = min(BATCH, int(w*h / r**2) + 1)
+        if add(num.random.random((batch, 2)) * size) < darts*batch: break
+
+    while len(pts) < n and len(active):  # Bridson: annulus around every active point
+        src = num.repeat(active, K)
+        angle = num.random.random(len(src)) * 2*num.pi
+        rad = r * num.sqrt(1 + 3*num.random.random(len(src)))  # uniform over the annulus area
+        cand = pts[src] + rad[:, None] * num.column_stack([num.cos(angle), num.sin(angle)])
+        if wrap: cand %= size
+        else: cand = cand[((cand >= 0) & (cand < size)).all(axis=1)]
+        active = num.zeros(0, dtype=int)  # each point gets one round
+        add(cand[num.random.permutation(len(cand))])
+    return pts
+
+def tile(r, size=None, root=TILES) -> NDArray:
+    """Periodic fill of a size x size square (default TILE radii), cached under root"""
+    size = size or TILE*r
+    file = path.join(root, f"r{r:g}-s{size:g}.npy") if root else None
+    if file and path.exists(file): return num.load(file)
+    pts = sample(size, size, r, wrap=True)
+    if file:
+        makedirs(root, exist_ok=True)
+        num.save(f"{file}.tmp.npy", pts); replace(f"{file}.tmp.npy", file)
+    return pts
+
+def tiled(w, h, r, size=None, root=TILES) -> NDArray:
+    """Fill of [0, w) x [0, h) from copies of tile(r), at a random offset"""
+    pts = tile(r, size, root); size = size or TILE*r
+    pts = (pts + num.random.random(2) * size) % size
+    reps = num.ceil(num.array([w, h]) / size).astype(int)
+    offsets = num.stack(num.meshgrid(num.arange(reps[0]), num.arange(reps[1]), indexing="ij"), -1)
+    pts = (pts[None] + offsets.reshape(-1, 1, 2) * size).reshape(-1, 2)
+    return pts[(pts < [w, h]).all(axis=1)]
@@ -1,14 +1,35 @@
 from math import inf, dist
 from typing import *
+from numpy.typing import NDArray
 from numpy import sign
-from contextlib import suppress
-from .rep import KINDS
+from contextlib import suppress, contextmanager
+from collections import namedtuple as data
+import numpy as num
+from multiprocessing import Pool
+from multiprocessing.shared_memory import SharedMemory
+from .rep import KINDS, COMMS, BLE, LINKS, ROWS, LinkMatrix, Runs
+from .index import Index
 
-def occlusion(start, end, cloud):
+density = {
+    "empty": 1,  # air: 100m
+    "shelf": 2,  # shelf: 50m
+    "pile": 3,   # pile: 33m
+    "wall": 5    # wall: 20m
+}
+
+# loss per metre indexed by kind code (see KINDS)
+ATTEN = num.array([density[KINDS[k]] for k in sorted(KINDS)], dtype=float)
+
+def occlusion(start, end, cloud, atten=ATTEN, budget=inf, trace=False):
+    """
+    Loss along the ray start -> end; marching stops once it exceeds budget.
+    trace=True marches the whole ray and returns (loss, [(kind, seg), ...]) for debugging
+    """
     ray = dist(start, end)
     # ~normalize direction vector
     diff = [(e - s)/ray for s, e in zip(start, end)]
-    obstacles = []
+    atten = list(atten)
+    loss, obstacles = 0, []
 
     pos = [int(coord) for coord in start]
     step = sign(diff).astype(int) # step direction
@@ -24,7 +45,10 @@ def occlusion(start, end, cloud):
         exits = min(*inters, ray)
         seg = exits - t; kind = 0
         with suppress(IndexError): kind = cloud[tuple(pos)]
-        if seg > 0.01: obstacles.append((kind, seg))
+        if seg > 0.01:
+            loss += atten[kind]*seg
+            if trace: obstacles.append((kind, seg))
+            elif loss > budget: break  # out of budget: link is dead
 
         for i, inter in enumerate(inters):  # i = axis of exit dir
             if inter == exits:
@@ -33,32 +57,369 @@ def occlusion(start, end, cloud):
 
         t = exits # t @ entry
 
-    return obstacles
+    return (loss, obstacles) if trace else loss
 
-density = {
-    "empty": 1,  # air: 100m
-    "shelf": 2,  # shelf: 50m
-    "pile": 3,   # pile: 33m
-    "wall": 5    # wall: 20m
-}
+def _rays(starts, ends):
+    starts = num.asarray(starts, dtype=float).reshape(-1, 3)
+    ends = num.asarray(ends, dtype=float).reshape(-1, 3)
+    ray = num.sqrt(((ends - starts)**2).sum(axis=1))
+    with num.errstate(divide="ignore", invalid="ignore"):
+        diff = (ends - starts) / ray[:, None]
+    return starts.T.copy(), diff.T.copy(), ray  # axis-first
+
+def _walk(start, diff, ray, loss, budget, *extra):
+    """
+    DDA shared by the batched engines: steps every ray through the unit grid of the axes
+    in start (axis-first), yielding (idx, pos, t, exits, *extra) for the active rays
+    """
+    pos = start.astype(int)
+    step = num.sign(diff).astype(int) # step direction
+    with num.errstate(divide="ignore", invalid="ignore"):
+        inters = num.where(diff != 0, (pos + (step > 0) - start) / diff, inf)
+        deltas = num.where(diff != 0, num.abs(1 / diff), inf)
+    idx = num.flatnonzero(ray > 0)
+    ray, pos, step, inters, deltas = ray[idx], pos[:, idx], step[:, idx], inters[:, idx], deltas[:, idx]
+    extra = [e[idx] for e in extra]
+    t = num.zeros(len(idx))
+
+    while len(idx):
+        exits = ray.copy()
+        for inter in inters: num.minimum(exits, inter, out=exits)
+        yield idx, pos, t, exits, *extra
+
+        hit = inters == exits  # axes of exit dir
+        pos += step * hit  # step into
+        inters += num.where(hit, deltas, 0)  # next boundary
+        t = exits
+
+        # finished rays only add zero-length segments, so compact lazily
+        live = (t < ray) & (loss[idx] <= budget)
+        if live.sum() < len(idx) * 0.75:
+            idx, ray, t = idx[live], ray[live], t[live]
+            pos, step, inters, deltas = pos[:, live], step[:, live], inters[:, live], deltas[:, live]
+            extra = [e[live] for e in extra]
+
+def _lookup(grid, pos, outside):
+    """grid[pos] per ray (pos axis-first), outside where pos leaves the grid"""
+    shape = num.array(grid.shape)[:, None]
+    inside = ((pos >= 0) & (pos < shape)).all(axis=0)
+    val = grid.ravel()[num.ravel_multi_index(pos, grid.shape, mode="clip")]
+    return num.where(inside, val, outside)
+
+def march(starts, ends, cloud, atten=ATTEN, budget=inf):
+    """
+    Batched form of occlusion: every ray's DDA state is advanced together. 
+    Returns the attenuated loss of each ray (sum of atten[kind]*seg); rays are retired
+    as soon as their loss exceeds budget (their loss is then only a lower bound).
+    cloud is either a kind volume or a float volume of loss per metre (rep.atten)
+    """
+    start, diff, ray = _rays(starts, ends)
+    loss = num.zeros(len(ray))
+    direct = cloud.dtype.kind == "f"  # voxels already hold loss per metre
+
+    for idx, pos, t, exits in _walk(start, diff, ray, loss, budget):
+        seg = exits - t
+        if direct: cost = _lookup(cloud, pos, atten[0])
+        else: cost = atten[_lookup(cloud, pos, 0)]
+        loss[idx] += num.where(seg > 0.01, cost * seg, 0)
+
+    return loss
+
+# pure heightfield: column (x, y) holds kinds[x, y] (None for loss volumes), costing
+# excess[x, y] per metre more than air, up to heights[x, y], and is air above
+Columns = data("Columns", "excess heights kinds")
+
+def heightfield(cloud, atten=ATTEN) -> Columns | None:
+    """Columns of cloud if every column is solid from the floor up (see rep._makeCloud)"""
+    if isinstance(cloud, Runs):  # at most one run per column, starting at the floor
+        X, Y, _ = cloud.shape; count = num.diff(cloud.ptr)
+        if count.max(initial=0) > 1 or cloud.z0.any(): return None
+        low, heights = num.zeros(X*Y, dtype=num.uint8), num.zeros(X*Y)
+        low[count > 0], heights[count > 0] = cloud.kinds, cloud.z1
+        low, heights = low.reshape(X, Y), heights.reshape(X, Y)
+        return Columns(atten[low] - atten[0], heights, low)
+    direct = cloud.dtype.kind == "f"
+    air = atten[0] if direct else 0
+    X, Y, Z = cloud.shape
+    heights, low = num.zeros((X, Y), dtype=int), num.zeros((X, Y), dtype=cloud.dtype)
+    z = num.arange(Z)
+    step = max(1, ROWS // (Y*Z))
+    for i in range(0, X, step):  # row blocks: a memmap is read once, through the page cache
+        block = num.asarray(cloud[i:i+step])
+        heights[i:i+step] = (block != air).sum(axis=2)
+        low[i:i+step] = block[..., 0]
+        fill = num.where(z < heights[i:i+step, :, None], low[i:i+step, :, None], air)
+        if not (block == fill).all(): return None
+    cost = low if direct else atten[low]
+    return Columns(cost - atten[0], heights.astype(float), None if direct else low)
+
+def _columns(start, diff, ray, loss, budget, cols: Columns):
+    """
+    2D walk over the columns, yielding (idx, seg, cell, under) where under is the part of
+    seg spent below the column top, solved analytically
+    """
+    shape = num.array(cols.heights.shape)[:, None]
+    heights = cols.heights.ravel()
+
+    for idx, pos, t, exits, z0, dz in _walk(start[:2], diff[:2], ray, loss, budget, start[2], diff[2]):
+        seg = exits - t
+        inside = ((pos >= 0) & (pos < shape)).all(axis=0)
+        cell = num.ravel_multi_index(pos, cols.heights.shape, mode="clip")
+        top = num.where(inside, heights[cell], 0)
+
+        # z(t) = z0 + dz*t is below top on [t, cross) if rising, (cross, exits] if falling
+        with num.errstate(divide="ignore", invalid="ignore"):
+            cross = (top - z0) / dz
+        lo = num.where(dz < 0, num.maximum(t, cross), t)
+        hi = num.where(dz > 0, num.minimum(exits, cross), exits)
+        under = num.where(dz == 0, seg * (z0 < top), num.clip(hi - lo, 0, None))
+        yield idx, seg, cell, under
+
+def column(starts, ends, cols: Columns, atten=ATTEN, budget=inf):
+    """
+    Heightfield form of march: a 2D DDA over the (x, y) columns instead of stepping in z.
+    Matches march up to its 0.01 minimum segment, which here applies per column
+    """
+    start, diff, ray = _rays(starts, ends)
+    loss = num.zeros(len(ray))
+    air, excess = atten[0], cols.excess.ravel()
+
+    for idx, seg, cell, under in _columns(start, diff, ray, loss, budget, cols):
+        loss[idx] += num.where(seg > 0.01, air*seg + excess[cell]*under, 0)
+
+    return loss
+
+def _runs(start, diff, ray, loss, budget, runs: Runs):
+    """
+    2D walk over the columns, yielding (idx, seg, of, run, under): for every run of the
+    current column of ray idx[of], the part of seg inside it, solved analytically
+    """
+    X, Y, _ = runs.shape
+    shape = num.array([X, Y])[:, None]
+
+    for idx, pos, t, exits, z0, dz in _walk(start[:2], diff[:2], ray, loss, budget, start[2], diff[2]):
+        seg = exits - t
+        inside = ((pos >= 0) & (pos < shape)).all(axis=0)
+        cell = num.ravel_multi_index(pos, (X, Y), mode="clip")
+        first = runs.ptr[cell]; count = num.where(inside, runs.ptr[cell + 1] - first, 0)
+
+        # every (ray, run of its column): t-interval where z(t) = z0 + dz*t is in the run
+        of = num.repeat(num.arange(len(idx)), count)
+        run = num.repeat(first - num.cumsum(count) + count, count) + num.arange(count.sum())
+        z, d = z0[of], dz[of]
+        with num.errstate(divide="ignore", invalid="ignore"):
+            ta, tb = (runs.z0[run] - z) / d, (runs.z1[run] - z) / d
+        flat = (runs.z0[run] <= z) & (z < runs.z1[run])  # dz == 0: all or nothing
+        lo = num.where(d == 0, num.where(flat, -inf, inf), num.minimum(ta, tb))
+        hi = num.where(d == 0, inf, num.maximum(ta, tb))
+        under = num.clip(num.minimum(hi, exits[of]) - num.maximum(lo, t[of]), 0, None)
+        yield idx, seg, of, run, under
+
+def stacked(starts, ends, runs: Runs, atten=ATTEN, budget=inf):
+    """
+    Run-length form of march: a 2D DDA over the columns that integrates, per column, the
+    part of the segment inside each run. Matches column (and march up to its 0.01 minimum
+    segment, which here applies per column)
+    """
+    start, diff, ray = _rays(starts, ends)
+    loss = num.zeros(len(ray))
+    air, excess = atten[0], num.asarray(atten) - atten[0]
+
+    for idx, seg, of, run, under in _runs(start, diff, ray, loss, budget, runs):
+        cost = num.bincount(of, excess[runs.kinds[run]]*under, minlength=len(idx))
+        loss[idx] += num.where(seg > 0.01, air*seg + cost, 0)
+
+    return loss
+
+def trace(starts, ends, scene, budget=inf):
+    """Loss of each ray through scene: Columns (heightfield), Runs or a voxel volume"""
+    if isinstance(scene, Columns): return column(starts, ends, scene, budget=budget)
+    if isinstance(scene, Runs): return stacked(starts, ends, scene, budget=budget)
+    return march(starts, ends, scene, budget=budget)
+
+def spans(starts, ends, scene, atten=ATTEN, budget=inf) -> NDArray:
+    """
+    Path length of each ray through each kind, shape (rays, kinds), in a single traversal.
+    scene is a kind volume, its Columns or Runs (not atten: losses don't tell kinds apart);
+    atten and budget only retire rays early (see march)
+    """
+    if getattr(scene, "kinds", scene) is None or getattr(scene, "dtype", num.dtype(int)).kind == "f":
+        raise TypeError("spans needs kinds: pass the kind cloud or rep.runs, not atten")
+    start, diff, ray = _rays(starts, ends)
+    lens = num.zeros((len(ray), len(KINDS)))
+    loss = num.zeros(len(ray))
+
+    if isinstance(scene, Runs):
+        for idx, seg, of, run, under in _runs(start, diff, ray, loss, budget, scene):
+            live = seg > 0.01
+            solid = num.zeros((len(idx), len(KINDS)))
+            num.add.at(solid, (of, scene.kinds[run]), under)
+            solid[~live] = 0
+            air = num.where(live, seg - solid.sum(axis=1), 0)
+            lens[idx] += solid; lens[idx, 0] += air
+            loss[idx] += atten[0]*air + solid @ atten
+    elif isinstance(scene, Columns):
+        kinds = scene.kinds.ravel()
+        for idx, seg, cell, under in _columns(start, diff, ray, loss, budget, scene):
+            live = seg > 0.01
+            air, solid = num.where(live, seg - under, 0), num.where(live, under, 0)
+            kind = kinds[cell]
+            lens[idx, 0] += air; lens[idx, kind] += solid
+            loss[idx] += atten[0]*air + atten[kind]*solid
+    else:
+        for idx, pos, t, exits in _walk(start, diff, ray, loss, budget):
+            seg = exits - t
+            seg = num.where(seg > 0.01, seg, 0)
+            kind = _lookup(scene, pos, 0)
+            lens[idx, kind] += seg
+            loss[idx] += atten[kind]*seg
+
+    return lens
 
 MAX_STREN = 100
+BATCH = 1 << 14  # rays per march
+
+# per technology (COMMS code): loss per metre by kind and link budget. Only BLE has a table
+# so far; callers with measured losses for the others pass them to techStren
+TECHS = {
+    COMMS.index(BLE): (density, MAX_STREN),
+}
+
+def _links(pairs, pos, scene):
+    """Compact result of a block of pairs: (kept rows, strengths)"""
+    A, B = pairs.T
+    loss = trace(pos[A], pos[B], scene, budget=MAX_STREN)
+    keep = num.flatnonzero(loss <= MAX_STREN)
+    return keep.astype(num.int32), (MAX_STREN - loss[keep]).astype(num.float32)
+
+def _serial(pairs, pos, scene, progress):
+    for i in range(0, len(pairs), BATCH):
+        keep, stren = _links(pairs[i:i+BATCH], pos, scene)
+        yield i + keep, stren
+        progress(len(pairs[i:i+BATCH]))
 
-def sigStren(cloud, mesh, callback):
+_worker = {}
+def _attach(pos, scene, name=None, shape=None, dtype=None, file=None, offset=0):
+    if name:  # no copy: view of parent's cloud
+        shm = SharedMemory(name=name)
+        scene = num.ndarray(shape, dtype, buffer=shm.buf)
+        _worker.update(shm=shm)
+    if file:  # memory-mapped cloud: map the same file, shared through the page cache
+        scene = num.memmap(file, dtype, "r", offset, shape)
+    _worker.update(pos=pos, scene=scene)
+
+def _block(pairs):
+    return _links(pairs, _worker["pos"], _worker["scene"])
+
+def _traced(job):
+    starts, ends = job
+    return trace(starts, ends, _worker["scene"], budget=MAX_STREN)
+
+@contextmanager
+def _pool(scene, procs, pos=None):
+    """Pool of procs workers with scene (and pos, if given) attached once, without a copy"""
+    shm = None; args = (pos, scene)
+    if isinstance(scene, num.memmap) and scene.filename:
+        args = (pos, None, None, scene.shape, scene.dtype, scene.filename, scene.offset)
+    elif not isinstance(scene, (Columns, Runs)):  # 2D columns and runs are small enough to pickle
+        shm = SharedMemory(create=True, size=max(1, scene.nbytes))
+        num.ndarray(scene.shape, scene.dtype, buffer=shm.buf)[:] = scene
+        args = (pos, None, shm.name, scene.shape, scene.dtype)
+    try:
+        with Pool(procs, _attach, args) as pool: yield pool
+    finally:
+        if shm: shm.close(); shm.unlink()
+
+def _parallel(pairs, pos, scene, procs, progress):
+    size = max(1, min(BATCH, -(-len(pairs) // (procs*4))))  # >= 4 blocks per worker
+    blocks = [pairs[i:i+size] for i in range(0, len(pairs), size)]
+    with _pool(scene, procs, pos) as pool:
+        results = pool.imap(_block, blocks)
+        for i, (keep, stren) in enumerate(results):
+            yield i*size + keep, stren
+            progress(len(blocks[i]))
+
+def _traceOn(pool, procs, starts, ends, scene):
+    """trace on the workers of a _pool(scene, procs); few rays (or no pool) are traced here"""
+    if pool is None or len(starts) < procs*1024: return trace(starts, ends, scene, budget=MAX_STREN)
+    size = -(-len(starts) // (procs*4))  # >= 4 blocks per worker
+    blocks = [(starts[i:i+size], ends[i:i+size]) for i in range(0, len(starts), size)]
+    return num.concatenate(pool.map(_traced, blocks))
+
+def _canonical(pairs, pos):
+    """Orient every pair so that it is always traced (and cached) in the same direction"""
+    d = pos[pairs[:, 1]] - pos[pairs[:, 0]]
+    first = d[num.arange(len(d)), (d != 0).argmax(axis=1)]  # lexicographic order
+    pairs[first < 0] = pairs[first < 0, ::-1]
+    return pairs
+
+def sigStren(cloud, mesh, callback, procs=1, cache=None):
+    """cache: optional LinkCache (sim/cache.py) consulted before casting any ray"""
     callback(0.0, "Determining signal strength")
-    cur, total = 0, len(mesh)
+    rows = LINKS.rows(list(mesh))
+    index = Index.of(mesh)
+    pairs, pos = _canonical(index.pairs(MAX_STREN), index.pos), index.pos
+    scene = heightfield(cloud) or cloud  # 2D traversal where the scene allows it
+
+    def link(pairs, stren):
+        LINKS.set(rows[pairs[:, 0]], rows[pairs[:, 1]], stren)
+
+    todo = pairs
+    if cache:
+        found, stren = cache.lookup(pos[pairs[:, 0]], pos[pairs[:, 1]])
+        live = found & (stren >= 0)
+        link(pairs[live], stren[live])
+        todo = pairs[~found]
+        traced = num.full(len(todo), -num.inf, dtype=num.float32)  # dead unless kept
+
+    done = len(pairs) - len(todo)
+    def progress(n):
+        nonlocal done; done += n
+        callback(done / len(pairs))
+
+    if procs > 1 and len(todo) > BATCH:
+        results = _parallel(todo, pos, scene, procs, progress)
+    else:
+        results = _serial(todo, pos, scene, progress)
+
+    for kept, stren in results:
+        link(todo[kept], stren)
+        if cache: traced[kept] = stren
+
+    if cache:
+        cache.store(pos[todo[:, 0]], pos[todo[:, 1]], traced); cache.flush()
+        callback(1.0, "Connections made", log=False, cache=round(cache.rate, 4))
+    else: callback(1.0, "Connections made", log=False)
+
+def techStren(cloud, mesh, callback, techs=TECHS, links=None) -> Dict[int, LinkMatrix]:
+    """
+    Links of mesh under every technology in techs (by COMMS code), one LinkMatrix each, into
+    links[code] if given (e.g. {code: LINKS}). Each ray is traversed once for its path length
+    per kind (cloud must hold kinds: a kind volume or Runs); every technology's loss is then a
+    matrix product with its table
+    """
+    callback(0.0, "Determining signal strength per technology")
+    tables = num.array([[table[KINDS[k]] for k in sorted(KINDS)] for table, _ in techs.values()])
+    budgets = num.array([budget for _, budget in techs.values()], dtype=float)
+    reach = (budgets / tables[:, 0]).max()  # farthest any technology can hear through air
 
-    for cA in mesh.values():
-        cur += 1
-        for cB in mesh.values():
-            if cA.name >= cB.name: continue
-            if dist(cA.pos, cB.pos) > MAX_STREN: continue
-            obstacles = occlusion(cA.pos, cB.pos, cloud)
-            loss = sum(density[KINDS[o[0]]]*o[1] for o in obstacles)
-            if loss > MAX_STREN: continue
-            strength = MAX_STREN - loss
+    index = Index.of(mesh)
+    pairs, pos = _canonical(index.pairs(reach), index.pos), index.pos
+    scene = heightfield(cloud) or cloud
+    given = links or {}
+    links = {code: given[code] if code in given else LinkMatrix() for code in techs}
+    rows = {code: store.rows(index.names) for code, store in links.items()}
 
-            cA.hears[cB.name] = cB.hears[cA.name] = strength
+    for i in range(0, len(pairs), BATCH):
+        block = pairs[i:i+BATCH]
+        # a ray dead under the most lenient table and budget is dead under all of them
+        lens = spans(pos[block[:, 0]], pos[block[:, 1]], scene, tables.min(axis=0), budgets.max())
+        loss = lens @ tables.T  # (rays, techs)
+        for t, (code, store) in enumerate(links.items()):
+            keep = loss[:, t] <= budgets[t]
+            A, B = rows[code][block[keep]].T
+            store.set(A, B, budgets[t] - loss[keep, t])
 
-        callback(cur / total)
+        callback(min(i + BATCH, len(pairs)) / len(pairs))
     callback(1.0, "Connections made", log=False)
+    return links
@@ -0,0 +1,24 @@
+import numpy as num
+from os import path
+from gen import build as b
+from sim import rep
+
+"""Incremental re-meshing"""
+
+def test_edit_remeshes_touched_strip(monkeypatch, tmp_path):
+    cores = 4; monkeypatch.setattr(b, "cpu_count", lambda: cores)  # 4 strips of 4 rows
+    kinds = num.random.default_rng(5).integers(0, len(rep.KINDS), (4*cores, 12)).astype(num.uint8)
+    kinds[2, 6] = 0
+    monkeypatch.setattr(rep, "MESH", rep.Fleet()); monkeypatch.setattr(rep, "TYPE", "BLE")
+    rep.init(kinds, num.zeros(kinds.shape, bool))
+    b.STRIPS.clear(); info = {}
+    build = lambda: b.build(rep.cloud, tmp_path, lambda v, s=None, **i: info.update(i))
+    build()
+    assert (info["strips"], info["remeshed"]) == (cores, cores)
+    glb = path.getsize(tmp_path / "scene.glb")
+
+    rep.edit([(2, 6, rep.H - 1, 3)])  # a wall voxel over empty floor, mid first strip
+    build()
+    assert (info["strips"], info["remeshed"]) == (cores, 1)
+    assert path.getsize(tmp_path / "scene.glb") != glb
+    assert rep.heights[2, 6] == rep.H and rep.runs.shape == rep.cloud.shape
@@ -0,0 +1,141 @@
+import numpy as num
+import random
+from threading import Thread
+from sim import rep
+from sim.rep import LinkMatrix
+
+"""Scene and link-store invariants"""
+
+def test_link_matrix_snapshots():
+    links = LinkMatrix(); links.rows(["a", "b", "c"])
+    links.set([0, 1], [1, 2], [5, 7])
+    before = links.matrix
+    links.set([2], [0], [3]); links.drop([0], [1])
+    assert before.toarray().tolist() == [[0, 5, 0], [5, 0, 7], [0, 7, 0]]
+    assert links.matrix.toarray().tolist() == [[0, 0, 3], [0, 0, 7], [3, 7, 0]]
+    assert links.matrix is links.matrix  # cached until the next write
+
+def test_hears_registers_on_write():
+    links = LinkMatrix(); links.rows(["a", "b"]); links.set([0], [1], [5])
+    ghost = links.hears("ghost")
+    assert dict(ghost) == {} and "a" not in ghost and links.hears("a").toJson() == {"b": 5}
+    ghost.clear()
+    assert links.names == ["a", "b"]  # reads register nothing
+    ghost["a"] = 2
+    assert links.names == ["a", "b", "ghost"] and links.hears("a") == {"b": 5, "ghost": 2}
+    del ghost["a"]
+    assert links.hears("a") == {"b": 5} and links.matrix.shape == (3, 3)
+
+def test_link_matrix_concurrent_reads():
+    links = LinkMatrix(); n = 50; links.rows([str(i) for i in range(n)])
+    pairs = num.array([(i, j) for i in range(n) for j in range(i + 1, n)])
+    done = False
+
+    def write():
+        for k in range(0, len(pairs), 25):
+            links.set(pairs[k:k+25, 0], pairs[k:k+25, 1], num.full(25, k, dtype=float))
+            if k % 100 == 0: links.drop(pairs[:k//2, 0], pairs[:k//2, 1])
+
+    writer = Thread(target=write); writer.start()
+    while not done:
+        done = not writer.is_alive()
+        mat = links.matrix  # always the symmetric matrix of one published state
+        assert (mat != mat.T).nnz == 0
+        assert mat.nnz % 2 == 0
+    writer.join()
+    assert links.matrix.nnz == 2*len(links._links[0])
+
+def test_rand_ints():
+    for a, b in [(1, 1), (0, 1), (1, 3), (1, 4), (1, 5), (0, 7), (3, 102), (0, 1 << 20), (0, 1 << 40)]:
+        random.seed(a*1000 + b); ref = [random.randint(a, b) for _ in range(1000)]
+        after = random.getstate()
+        random.seed(a*1000 + b)
+        assert rep._randInts(1000, a, b).tolist() == ref, (a, b)
+        assert random.getstate() == after, (a, b)
+
+def _oldHeight(kind):  # the per-chunk version _makeHeights replaced
+    return {"empty": 0, "shelf": rep.H // 2, "pile": random.randint(1, rep.H // 4), "wall": rep.H}[rep.KINDS[kind]]
+
+def test_make_heights():
+    kinds = num.random.default_rng(0).integers(0, len(rep.KINDS), (40, 30))
+    random.seed(7); ref = num.vectorize(_oldHeight)(kinds); after = random.getstate()
+    random.seed(7); heights = rep._makeHeights(kinds)
+    assert num.array_equal(heights, ref) and heights.dtype == ref.dtype
+    assert random.getstate() == after
+
+    # in blocks, only the first one draws for the num.vectorize probe
+    random.seed(7); blocks = num.vstack([rep._makeHeights(kinds[:15]), rep._makeHeights(kinds[15:], probe=False)])
+    assert num.array_equal(blocks, ref) and random.getstate() == after
+
+def test_make_nodes(monkeypatch):
+    # a 3x3 plus: a shelf, free on its sides towards three empty chunks and a lower pile
+    kinds = num.array([[0, 0, 0], [0, 1, 2], [0, 0, 0]], dtype=num.uint8)
+    heights = num.array([[0, 0, 0], [0, rep.H // 2, 2], [0, 0, 0]])
+    monkeypatch.setattr(rep, "SCENE", rep.Scene(kinds, heights), raising=False)  # set by init
+    monkeypatch.setattr(rep, "runs", rep.Runs.columns(kinds, heights, rep.H), raising=False)
+    monkeypatch.setattr(rep, "MESH", rep.Fleet()); monkeypatch.setattr(rep, "TYPE", "BLE")
+    num.random.seed(7); n = 40000
+
+    face, z = rep._faces(num.tile([1, 1], (n, 1)))
+    assert num.allclose(num.bincount(face, minlength=5)[:5] / n, 0.2, atol=0.01)  # 4 sides + top
+    assert (z[face == rep.TOP] == rep.H // 2).all()
+    assert num.allclose(num.bincount(z[face == 0]), [0]*3 + [len(z[face == 0]) / 8]*8, rtol=0.1)  # above the pile
+    assert num.allclose(num.bincount(z[face == 2]), [0] + [len(z[face == 2]) / 10]*10, rtol=0.1)
+
+    face, z = rep._faces(num.tile([0, 0], (n, 1)))
+    assert set(face.tolist()) == {rep.CIEL, rep.FLOOR} and abs((face == rep.CIEL).mean() - 0.5) < 0.01
+    assert (z == num.where(face == rep.CIEL, rep.H, 0)).all()
+
+    cells, _ = rep._makeNodes(num.ones(kinds.shape, bool))
+    assert len(cells) == 9 and len(rep.MESH) == 9
+    pitch, yaw, roll = [], [], []
+    for _ in range(1000):
+        rep.MESH = rep.Fleet(); rep._makeNodes(num.array([[0, 0, 0], [0, 1, 0], [0, 0, 0]], bool))
+        (p, y, r), = rep.MESH.orient.tolist(); pitch.append(p); yaw.append(y); roll.append(r)
+    pitch, yaw, roll = map(num.array, (pitch, yaw, roll))
+    assert ((pitch >= 0) & (pitch <= 180)).all() and ((yaw >= -90) & (yaw <= 360)).all()
+    assert ((roll >= 0) & (roll < 360)).all() and abs(roll.mean() - 180) < 10
+
+def test_fleet_move_keeps_fractions():
+    fleet = rep.Fleet(); fleet.add(["a", "b"], "BLE", [(1, 2, 3), (4, 5, 6)], num.zeros((2, 3)))
+    fleet.move({"b": (4.5, 5.25, 6.75)})
+    fleet["a"].pos = rep.Coord(0.5, 2, 3)
+    assert fleet.pos.tolist() == [[0.5, 2, 3], [4.5, 5.25, 6.75]]
+
+def test_save_load(monkeypatch, tmp_path):
+    rng = num.random.default_rng(4)
+    kinds = rng.integers(0, len(rep.KINDS), (8, 10)).astype(num.uint8)
+    monkeypatch.setattr(rep, "MESH", rep.Fleet()); monkeypatch.setattr(rep, "TYPE", "BLE")
+    levels = rep.Runs.of(rep._makeCloud(kinds, rep._makeHeights(kinds)) * (rng.random((8, 10, rep.H)) < 0.7))
+    for given in (None, levels):
+        rep.init(kinds, num.zeros(kinds.shape, bool), levels=given, dense=False)
+        assert rep.cloud is None
+        saved = rep.runs; rep.save(tmp_path)
+        rep.load(tmp_path, dense=False)
+        assert rep.cloud is None and rep.runs.shape == saved.shape
+        assert all((getattr(rep.runs, f) == getattr(saved, f)).all() for f in rep.Runs.FIELDS)
+        rep.load(tmp_path)
+        assert (rep.cloud == saved.dense(num.zeros(saved.shape, num.uint8))).all()
+
+def test_make_nodes_levels(monkeypatch):
+    # a deck at z 20..22 over air, with a slab on the floor under half of it
+    cloud = num.zeros((12, 12, 24), num.uint8); cloud[1:11, 1:11, 20:22] = 1; cloud[1:6, 1:11, 0] = 3
+    levels = rep.Runs.of(cloud)
+    monkeypatch.setattr(rep, "MESH", rep.Fleet()); monkeypatch.setattr(rep, "TYPE", "BLE")
+    num.random.seed(8); rep.init(cloud.max(axis=2), num.zeros((12, 12), bool), levels=levels)
+    face, z = rep._faces(num.argwhere(cloud[..., 20] != 0).repeat(50, axis=0))
+    on = face >= 0
+    assert set(z[on].tolist()) <= {1, 21, 22}  # the deck's sides and top, or the slab's
+    assert (face[z == 1] == rep.TOP).any()  # the lower level is reachable
+    assert num.isin(z[face == rep.TOP], [1, 22]).all()
+
+def test_edit_patches_runs(monkeypatch):
+    rng = num.random.default_rng(6)
+    kinds = rng.integers(0, len(rep.KINDS), (10, 14)).astype(num.uint8)
+    monkeypatch.setattr(rep, "MESH", rep.Fleet()); monkeypatch.setattr(rep, "TYPE", "BLE")
+    rep.init(kinds, num.zeros(kinds.shape, bool))
+    for _ in range(5):
+        rep.edit(num.column_stack([rng.integers(0, rep.cloud.shape, (8, 3)), rng.integers(0, len(rep.KINDS), 8)]))
+        whole = rep.Runs.of(rep.cloud)
+        assert all((getattr(rep.runs, f) == getattr(whole, f)).all() for f in rep.Runs.FIELDS)
+        assert (rep.heights == whole.top()[0]).all() and (rep.SCENE.kinds == whole.top()[1]).all()
@@ -0,0 +1,112 @@
+import numpy as num
+import pytest
+from os import stat
+from sim import rep, links, signal
+from sim.motion import Motion, Tags
+from sim.signal import occlusion, march, column, stacked, heightfield, spans, sigStren, techStren, ATTEN, MAX_STREN, density
+from sim.cache import LinkCache
+
+"""Batched tracers against the per-ray reference (occlusion) on integer rays"""
+
+@pytest.fixture
+def cloud():
+    rng = num.random.default_rng(0)
+    kinds = rng.integers(0, len(rep.KINDS), (12, 16)).astype(num.uint8)
+    heights = rng.integers(0, rep.H + 1, kinds.shape).astype(num.int16)
+    return rep._makeCloud(kinds, heights)
+
+def rays(cloud, n=300, seed=1):
+    rng = num.random.default_rng(seed)
+    starts = rng.integers(0, cloud.shape, (n, 3))
+    ends = rng.integers(0, cloud.shape, (n, 3))
+    keep = (starts != ends).any(axis=1)
+    return starts[keep], ends[keep]
+
+def reference(starts, ends, cloud):
+    return num.array([occlusion(tuple(s), tuple(e), cloud) for s, e in zip(starts.tolist(), ends.tolist())])
+
+def test_march(cloud):
+    starts, ends = rays(cloud)
+    assert num.allclose(march(starts, ends, cloud), reference(starts, ends, cloud))
+
+def test_column(cloud):
+    starts, ends = rays(cloud)
+    cols = heightfield(cloud)
+    assert cols is not None
+    assert num.allclose(column(starts, ends, cols), reference(starts, ends, cloud))
+
+def test_stacked(cloud):
+    # hollow out some columns so that they hold several runs
+    cloud = cloud.copy(); cloud[::2, ::3, 3:7] = 0; cloud[1::3, ::2, 12:15] = 3
+    starts, ends = rays(cloud)
+    assert heightfield(cloud) is None
+    assert num.allclose(stacked(starts, ends, rep.Runs.of(cloud)), reference(starts, ends, cloud))
+
+def test_spans(cloud):
+    starts, ends = rays(cloud)
+    loss = march(starts, ends, cloud)
+    assert num.allclose(spans(starts, ends, cloud) @ ATTEN, loss)
+    assert num.allclose(spans(starts, ends, heightfield(cloud)) @ ATTEN, loss)
+    cloud = cloud.copy(); cloud[::2, ::3, 3:7] = 0  # several runs per column
+    assert num.allclose(spans(starts, ends, rep.Runs.of(cloud)) @ ATTEN, march(starts, ends, cloud))
+    with pytest.raises(TypeError):
+        spans(starts, ends, ATTEN.astype(num.float32)[cloud])
+
+def test_tech_stren(cloud, monkeypatch):
+    rng = num.random.default_rng(3); n = 30
+    mesh = rep.Fleet(); mesh.add([f"C{i}" for i in range(n)], "BLE", rng.random((n, 3)) * cloud.shape, num.zeros((n, 3)))
+    runs = rep.Runs.of(cloud * (rng.random(cloud.shape) < 0.8))
+    ble, wifi = rep.COMMS.index(rep.BLE), rep.COMMS.index(rep.WiFi)
+    techs = {ble: (density, MAX_STREN), wifi: ({k: 2*v for k, v in density.items()}, MAX_STREN)}
+    monkeypatch.setattr(signal, "LINKS", rep.LinkMatrix())
+    sigStren(runs, mesh, lambda *a, **k: None)
+    links = techStren(runs, mesh, lambda *a, **k: None, techs)
+    assert num.allclose(links[ble].matrix.toarray(), signal.LINKS.matrix.toarray(), atol=1e-4)
+    assert links[wifi].matrix.nnz < links[ble].matrix.nnz  # twice the loss: fewer links
+
+def test_cache_hits_skip_write(cloud, tmp_path):
+    cache = LinkCache.of(cloud, root=tmp_path)
+    starts, ends = rays(cloud, 20)
+    found, _ = cache.lookup(starts, ends)
+    cache.store(starts[~found], ends[~found], march(starts, ends, cloud)[~found]); cache.flush()
+    written = stat(cache.file).st_ino  # flush replaces the file
+
+    cache = LinkCache.of(cloud, root=tmp_path)
+    found, stren = cache.lookup(starts, ends)
+    assert found.all() and cache.rate == 1
+    cache.store(starts[~found], ends[~found], stren[~found]); cache.flush()
+    assert stat(cache.file).st_ino == written and not cache._new
+
+@pytest.mark.parametrize("dense", [True, False])
+def test_links_match_sigstren(cloud, monkeypatch, dense):
+    rng = num.random.default_rng(2)
+    mesh = rep.Fleet(); n = 40
+    mesh.add([f"C{i}" for i in range(n)], "BLE", rng.random((n, 3)) * cloud.shape, num.zeros((n, 3)))
+    monkeypatch.setattr(links, "LINKS", rep.LinkMatrix())
+    scene = cloud.copy() if dense else rep.Runs.of(cloud)
+    incremental = links.Links(scene, mesh)
+    for _ in range(5):
+        names = rng.choice(n, 4, replace=False)
+        incremental.move({f"C{i}": tuple(p) for i, p in zip(names, rng.random((4, 3)) * cloud.shape)})
+        at = rng.integers(0, cloud.shape, (6, 3)); kind = rng.integers(0, len(rep.KINDS), 6)
+        edited = (scene if dense else scene.dense(num.zeros(cloud.shape, num.uint8))).copy()
+        edited[tuple(at.T)] = kind
+        if dense: scene[:] = edited; incremental.edit(at)
+        else: scene = rep.Runs.of(edited); incremental.edit(at, scene)
+
+    monkeypatch.setattr(signal, "LINKS", rep.LinkMatrix())
+    sigStren(scene, mesh, lambda *a, **k: None)
+    assert links.LINKS.names == signal.LINKS.names
+    assert num.allclose(links.LINKS.matrix.toarray(), signal.LINKS.matrix.toarray(), atol=1e-4)
+
+def test_motion_workers(cloud):
+    rng = num.random.default_rng(4)
+    mesh = rep.Fleet(); n = 40
+    mesh.add([f"C{i}" for i in range(n)], "BLE", rng.random((n, 3)) * cloud.shape, num.zeros((n, 3)))
+    num.random.seed(4); tags = Tags.random(600, cloud.shape)
+    serial = Motion(cloud, mesh, tags, procs=1)
+    with Motion(cloud, mesh, Tags(tags.paths, tags.speed), procs=2) as pooled:
+        for _ in range(3):
+            assert pooled._pool is not None and pooled.step().nnz > 2048
+            assert num.allclose(pooled.rssi.toarray(), serial.step().toarray())
+    assert pooled._pool is None and len(pooled.timings) == 3